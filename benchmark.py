@@ -0,0 +1,546 @@
+# MIT License
+
+# Copyright (c) 2023 Holger Teutsch
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import sys, os, time, subprocess, tempfile, statistics, shutil, struct, random, json
+import logging, tracemalloc
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import o4xp_2_xp12 as o4x
+
+MB = 1024 * 1024
+
+# XP12 layers of a tile: name, width, bytes per pixel
+XP12_RASTERS = [
+    ("elevation", 1201, 2),
+    ("sea_level", 301, 2),
+    ("soundscape", 301, 1),
+    ("spr1", 301, 1),
+    ("sum1", 301, 1),
+    ("fal1", 301, 1),
+    ("win1", 301, 1),
+]
+
+ORTHO_PACK = "zOrtho4XP_bench"
+VERTEX_BYTES = 10  # a PATCH_VERTEX line carries 5 uint16 of GEOD
+
+
+##########
+## synthetic fixtures
+##########
+def tile_name(i):
+    """Name and 10x10 directory of the i-th tile of a fixture"""
+    lat = 50 + i // 10
+    lon = i % 10
+    return f"{lat:+03d}{lon:+04d}", f"{lat // 10 * 10:+03d}{lon // 10 * 10:+04d}"
+
+
+def geod_bytes(rng, size):
+    """size bytes of geometry, compresses about 1.3:1 like real meshes"""
+    table = bytes(i & 0x3F for i in range(256))
+    return rng.randbytes(size).translate(table)
+
+
+def atoms_bytes(atoms):
+    return b"".join(o4x.DsfAtoms.atom_bytes(id, p) + bytes(p) for id, p in atoms)
+
+
+def make_dsf(fname, atoms):
+    """Write a DSF of top level atoms = list of [id, payload]"""
+    dsf = o4x.DsfAtoms.__new__(o4x.DsfAtoms)
+    dsf.version = 1
+    dsf.atoms = atoms
+    dsf.write(fname)
+
+
+def make_tile(fname, rng, size, xp12):
+    """A DSF with a mesh of about size bytes, with the XP12 rasters if xp12"""
+    defn = [["TERT", b"terrain_Water\0lib/g10/terrain10/ortho.ter\0"], ["OBJT", b""]]
+    rasters = []
+    if xp12:
+        defn.append(["DEMN", b"".join(n.encode() + b"\0" for n, _, _ in XP12_RASTERS)])
+        for name, width, bpp in XP12_RASTERS:
+            demi = struct.pack("<BBHIIff", 1, bpp, 1 if bpp == 1 else 5, width, width, 1.0, 0.0)
+            rasters.append(["DEMI", demi])
+            rasters.append(["DEMD", geod_bytes(rng, width * width * bpp)])
+
+    atoms = [
+        ["HEAD", atoms_bytes([["PROP", b"sim/west\0" + b"0\0sim/south\0" + b"50\0"]])],
+        ["DEFN", atoms_bytes(defn)],
+        ["GEOD", geod_bytes(rng, size - size % VERTEX_BYTES)],
+    ]
+    if xp12:
+        atoms.append(["DEMS", atoms_bytes(rasters)])
+    atoms.append(["CMDS", geod_bytes(rng, max(size // 20, 16))])
+    make_dsf(fname, atoms)
+
+
+def make_fixture(dir, n_tiles, size, seed=1):
+    """Create an XP12 root with n_tiles tiles of about size bytes in dir.
+
+    dir/X-Plane 12      global scenery and an Ortho4XP pack
+    dir/ortho.orig      pristine copy of the pack, see restore()
+    dir/tools           stub dsf_tool and 7z
+    dir/work            work_dir
+    dir/o4xp_2_xp12.ini to run the real thing against the fixture
+    """
+    rng = random.Random(seed)
+    xp12_root = os.path.join(dir, "X-Plane 12")
+    for i in range(n_tiles):
+        name, tdir = tile_name(i)
+        for scenery, xp12 in [
+            ("Global Scenery/X-Plane 12 Global Scenery", True),
+            (f"Custom Scenery/{ORTHO_PACK}", False),
+        ]:
+            d = os.path.join(xp12_root, scenery, "Earth nav data", tdir)
+            os.makedirs(d, exist_ok=True)
+            make_tile(os.path.join(d, name + ".dsf"), rng, size, xp12)
+
+    shutil.copytree(
+        os.path.join(xp12_root, "Custom Scenery", ORTHO_PACK), os.path.join(dir, "ortho.orig")
+    )
+    tools = os.path.join(dir, "tools")
+    os.makedirs(tools)
+    for tool in ["dsf_tool", "7z"]:
+        fname = os.path.join(tools, tool)
+        with open(fname, "w") as f:
+            f.write(
+                f"#!{sys.executable}\n"
+                "import sys\n"
+                f"sys.path.insert(0, {SCRIPT_DIR!r})\n"
+                "import benchmark\n"
+                f"benchmark.stub_{tool.replace('7z', '7zip')}(sys.argv[1:])\n"
+            )
+        os.chmod(fname, 0o755)
+
+    os.makedirs(os.path.join(dir, "work"))
+    with open(os.path.join(dir, "o4xp_2_xp12.ini"), "w") as f:
+        f.write(
+            "[DEFAULTS]\n"
+            f"xp12_root = {xp12_root}\n"
+            "ortho_dir = %(xp12_root)s/Custom Scenery\n"
+            f"work_dir = {os.path.join(dir, 'work')}\n"
+            "num_workers = 2\n"
+            "tile_index = no\n"
+            "raster_cache_size = 0\n"
+            "\n[TOOLS]\n"
+            f"dsf_tool = {os.path.join(tools, 'dsf_tool')}\n"
+        )
+
+
+def restore(dir):
+    """Put back the pristine Ortho4XP pack, removes backups and markers"""
+    pack = os.path.join(dir, "X-Plane 12", "Custom Scenery", ORTHO_PACK)
+    shutil.rmtree(pack)
+    shutil.copytree(os.path.join(dir, "ortho.orig"), pack)
+
+
+##########
+## stubs of the external tools, emulate their I/O
+##########
+def stub_dsf_tool(args):
+    """dsf_tool -dsf2text|-text2dsf in out"""
+    if len(args) != 3 or args[0] not in ["-dsf2text", "-text2dsf"]:
+        print("usage: dsf_tool -dsf2text|-text2dsf in out")
+        sys.exit(1)
+
+    if args[0] == "-dsf2text":
+        dsf2text(args[1], args[2])
+    else:
+        text2dsf(args[1], args[2])
+
+
+def dsf2text(dsf_name, txt_name):
+    """Dump as dsf_tool does: header, defs, RASTER_ lines, the mesh; rasters go to .raw files"""
+    dsf = o4x.DsfAtoms.read(dsf_name)
+    with open(txt_name, "w") as f:
+        f.write("I\n800\nDSF2TEXT\n\n")
+        props = dsf.string_table(dsf.get_sub("HEAD", "PROP") or b"")
+        for k, v in zip(props[0::2], props[1::2]):
+            f.write(f"PROPERTY {k} {v}\n")
+        for t in dsf.string_table(dsf.get_sub("DEFN", "TERT") or b""):
+            f.write(f"TERRAIN_DEF {t}\n")
+
+        rasters = dsf.rasters()
+        for i, (name, _, _) in enumerate(rasters):
+            f.write(f"RASTER_DEF {i} {name}\n")
+        for name, demi, demd in rasters:
+            version, bpp, flags, width, height, scale, offset = struct.unpack(
+                "<BBHIIff", demi[:20]
+            )
+            raw = f"{txt_name}.{name}.raw"
+            with open(raw, "wb") as r:
+                r.write(demd)
+            f.write(
+                f"RASTER_DATA version={version} bpp={bpp} flags={flags} width={width}"
+                f" height={height} scale={scale:.9g} offset={offset:.9g} {raw}\n"
+            )
+
+        geod = dsf.get("GEOD")
+        f.write("BEGIN_PATCH 0 0.000000 -1.000000 1 5\nBEGIN_PRIMITIVE 0\n")
+        for v in struct.iter_unpack("<5H", geod[: len(geod) - len(geod) % VERTEX_BYTES]):
+            f.write("PATCH_VERTEX %.9f %.9f %.9f %.9f %.9f\n" % tuple(x / 65535 for x in v))
+        f.write("END_PRIMITIVE\nEND_PATCH\n")
+        f.write(f"# CMDS {bytes(dsf.get('CMDS')).hex()}\n")
+
+
+def text2dsf(txt_name, dsf_name):
+    """Build the DSF back from a dump of dsf2text"""
+    props = []
+    terrains = []
+    names = []
+    dems = []
+    geod = bytearray()
+    cmds = b""
+    with open(txt_name, "r") as f:
+        for l in f:
+            if l.startswith("PATCH_VERTEX"):
+                geod += struct.pack("<5H", *(round(float(x) * 65535) for x in l.split()[1:6]))
+            elif l.startswith("PROPERTY"):
+                props.extend(l.split()[1:3])
+            elif l.startswith("TERRAIN_DEF"):
+                terrains.append(l.split()[1])
+            elif l.startswith("RASTER_DEF"):
+                names.append(l.split()[2])
+            elif l.startswith("RASTER_DATA"):
+                words = l.rstrip("\r\n").split(" ", 8)
+                v = dict(w.split("=") for w in words[1:8])
+                demi = struct.pack(
+                    "<BBHIIff",
+                    int(v["version"]),
+                    int(v["bpp"]),
+                    int(v["flags"]),
+                    int(v["width"]),
+                    int(v["height"]),
+                    float(v["scale"]),
+                    float(v["offset"]),
+                )
+                with open(words[8], "rb") as r:
+                    dems += [["DEMI", demi], ["DEMD", r.read()]]
+            elif l.startswith("# CMDS"):
+                cmds = bytes.fromhex(l.split()[2])
+
+    def table(strings):
+        return b"".join(s.encode() + b"\0" for s in strings)
+
+    defn = [["TERT", table(terrains)], ["OBJT", b""]]
+    if len(names) > 0:
+        defn.append(["DEMN", table(names)])
+    atoms = [
+        ["HEAD", atoms_bytes([["PROP", table(props)]])],
+        ["DEFN", atoms_bytes(defn)],
+        ["GEOD", bytes(geod)],
+    ]
+    if len(dems) > 0:
+        atoms.append(["DEMS", atoms_bytes(dems)])
+    atoms.append(["CMDS", cmds])
+    make_dsf(dsf_name, atoms)
+
+
+def stub_7zip(args):
+    """7z a -t7z -m0=lzma archive file"""
+    if len(args) < 3 or args[0] != "a":
+        print("usage: 7z a [-switches] archive file")
+        sys.exit(1)
+
+    src = args[-1]
+    o4x.write_7z(src, args[-2], os.path.basename(src))
+
+
+def time_command(cmd, runs, cwd):
+    """Run cmd runs times in cwd, return the list of wall times"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def startup(runs, commands):
+    """Cold start latency: time to start, read the config and exit.
+
+    The commands run in an empty directory, without an ini file they stop
+    right after initialization. Without commands the scripts are timed.
+    """
+    if len(commands) == 0:
+        commands = [
+            [sys.executable, os.path.join(SCRIPT_DIR, "o4xp_2_xp12.py"), "-dry_run", "convert"],
+            [sys.executable, os.path.join(SCRIPT_DIR, "raster_tool.py")],
+        ]
+
+    print(f"{'command':40s} {'runs':>5s} {'min':>8s} {'median':>8s} {'max':>8s}")
+    with tempfile.TemporaryDirectory() as cwd:
+        for cmd in commands:
+            times = time_command(cmd, runs, cwd)
+            name = " ".join(os.path.basename(c) for c in cmd[:2] if not c.startswith("-"))
+            print(f"{name[-40:]:40s} {runs:5d} {min(times):8.3f} {statistics.median(times):8.3f} {max(times):8.3f}")
+
+
+##########
+## pipeline benchmarks
+##########
+def setup(dir, engine, compressor):
+    """Configure o4xp_2_xp12 as main() would for the fixture in dir"""
+    o4x.xp12_root = os.path.join(dir, "X-Plane 12")
+    o4x.work_dir = os.path.join(dir, "work")
+    o4x.dsf_tool = os.path.join(dir, "tools", "dsf_tool")
+    o4x.engine = engine
+    o4x.cmd_7zip = os.path.join(dir, "tools", "7z") if compressor == "7zip" else None
+    o4x.xp12_map = o4x.Xp12Map(o4x.xp12_root)
+    o4x.xp12_map.build()
+
+
+def dsf_list():
+    return o4x.DsfList(
+        ORTHO_PACK, o4x.xp12_root, os.path.join(o4x.xp12_root, "Custom Scenery")
+    )
+
+
+def measure(fn, runs, prepare=None):
+    """Run fn runs times, return median wall time and peak of Python allocations.
+
+    prepare() runs untimed before each run. The allocations are traced in
+    an extra run as tracing slows everything down.
+    """
+    times = []
+    for _ in range(runs):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    if prepare is not None:
+        prepare()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(times), peak
+
+
+def bench_convert(dir, runs):
+    """Dsf.convert of the first tile"""
+    name, tdir = tile_name(0)
+    fname = os.path.join(o4x.xp12_root, "Custom Scenery", ORTHO_PACK, "Earth nav data", tdir, name + ".dsf")
+
+    def convert():
+        assert o4x.Dsf(fname).convert(), "conversion failed"
+
+    return measure(convert, runs, lambda: restore(dir))
+
+
+def bench_scan(dir, runs, preflight):
+    """DsfList.scan of all tiles"""
+    restore(dir)  # unconverted, so every tile is queued and preflighted
+
+    def scan():
+        dl = dsf_list()
+        dl.preflight = preflight
+        o4x.xp12_map = o4x.Xp12Map(o4x.xp12_root)  # cold map
+        o4x.xp12_map.build()
+        dl.scan(o4x.DsfList.M_CONVERT, 10000000, None, None)
+
+    return measure(scan, runs)
+
+
+def bench_execute(dir, runs, n_workers):
+    """DsfList.execute of all tiles with n_workers per stage"""
+    dl = None
+
+    def prepare():
+        nonlocal dl
+        restore(dir)
+        dl = dsf_list()
+        dl.scan(o4x.DsfList.M_CONVERT, 10000000, None, None)
+
+    def execute():
+        dl.execute(n_workers, o4x.DsfList.M_CONVERT, [n_workers] * len(o4x.DsfList.STAGES))
+        assert dl.queue.qsize() == 0
+
+    return measure(execute, runs, prepare)
+
+
+def suite(runs, sizes, n_tiles, workers, engines, compressor):
+    """Run all benchmarks, return list of results"""
+    results = []
+
+    def report(bench, params, wall, peak, nbytes):
+        res = {
+            "bench": bench,
+            **params,
+            "wall": round(wall, 4),
+            "mb_s": round(nbytes / MB / wall, 2),
+            "peak_mb": round(peak / MB, 2),
+        }
+        results.append(res)
+        p = " ".join(f"{k}={v}" for k, v in params.items())
+        print(f"{bench:8s} {p:45s} {wall:8.4f} s {res['mb_s']:8.2f} MB/s {res['peak_mb']:8.1f} MB")
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as dir:
+            make_fixture(dir, n_tiles, int(size * MB))
+            nbytes = os.path.getsize(os.path.join(dir, "ortho.orig", "Earth nav data", tile_name(0)[1], tile_name(0)[0] + ".dsf"))
+            for engine in engines:
+                setup(dir, engine, compressor)
+                params = {"engine": engine, "compressor": compressor, "size_mb": size}
+                report("convert", params, *bench_convert(dir, runs), nbytes)
+                for n in workers:
+                    report("execute", {**params, "tiles": n_tiles, "workers": n}, *bench_execute(dir, runs, n), n_tiles * nbytes)
+
+            for preflight in [False, True]:
+                params = {"size_mb": size, "tiles": n_tiles, "preflight": preflight}
+                report("scan", params, *bench_scan(dir, runs, preflight), n_tiles * nbytes)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the results that are slower or need more memory than baseline + tolerance %"""
+
+    def key(res):
+        return tuple((k, v) for k, v in res.items() if k not in ["wall", "mb_s", "peak_mb"])
+
+    base = {key(res): res for res in baseline}
+    regressions = []
+    for res in results:
+        b = base.get(key(res))
+        if b is None:
+            continue
+
+        for m in ["wall", "peak_mb"]:
+            if res[m] > b[m] * (1 + tolerance / 100):
+                regressions.append(f"{' '.join(f'{k}={v}' for k, v in key(res))}: {m} {b[m]} -> {res[m]}")
+
+    return regressions
+
+
+def usage():
+    print(
+        """benchmark startup [-n runs] [command ...]
+benchmark suite [-n runs] [-sizes mb,...] [-tiles n] [-workers n,...] [-engine e,...]
+                [-compressor builtin|7zip] [-json file] [-baseline file] [-tolerance pct]
+benchmark fixture dir [-sizes mb] [-tiles n]
+    startup     cold start latency of the scripts or the given command, e.g. the frozen binary
+                    benchmark startup -n 20 ./o4xp_2_xp12/o4xp_2_xp12.exe
+    suite       time Dsf.convert, DsfList.scan and DsfList.execute on synthetic tiles
+                with stub dsf_tool and 7z, no X-Plane needed
+    fixture     create the synthetic X-Plane root, tools and ini in dir
+    -n runs     number of runs, default 10 for startup, 3 for suite
+    -sizes      tile sizes in MB, default 1
+    -tiles      tiles per fixture, default 4
+    -workers    workers per stage for execute, default 1,2
+    -engine     default dsf_tool,native
+    -compressor default builtin
+    -json       write the results to file
+    -baseline   compare with the results of an earlier run, exit code 1 if
+                wall time or memory grew more than -tolerance percent, default 25"""
+    )
+    sys.exit(2)
+
+
+def main():
+    if len(sys.argv) < 2:
+        usage()
+
+    what = sys.argv[1]
+    runs = None
+    sizes = [1]
+    n_tiles = 4
+    workers = [1, 2]
+    engines = ["dsf_tool", "native"]
+    compressor = "builtin"
+    json_name = None
+    baseline = None
+    tolerance = 25.0
+    args = []
+
+    opts = ["-n", "-sizes", "-tiles", "-workers", "-engine", "-compressor", "-json", "-baseline", "-tolerance"]
+    i = 2
+    while i < len(sys.argv):
+        opt = sys.argv[i]
+        if opt not in opts:
+            args.append(opt)
+            i = i + 1
+            continue
+
+        i = i + 1
+        if i >= len(sys.argv):
+            usage()
+        val = sys.argv[i]
+        if opt == "-n":
+            runs = int(val)
+        elif opt == "-sizes":
+            sizes = [float(x) if "." in x else int(x) for x in val.split(",")]
+        elif opt == "-tiles":
+            n_tiles = int(val)
+        elif opt == "-workers":
+            workers = [int(x) for x in val.split(",")]
+        elif opt == "-engine":
+            engines = val.split(",")
+        elif opt == "-compressor":
+            compressor = val
+        elif opt == "-json":
+            json_name = val
+        elif opt == "-baseline":
+            baseline = val
+        elif opt == "-tolerance":
+            tolerance = float(val)
+        i = i + 1
+
+    if what == "startup":
+        startup(runs or 10, [args] if len(args) > 0 else [])
+
+    elif what == "fixture":
+        if len(args) != 1:
+            usage()
+        make_fixture(args[0], n_tiles, int(sizes[0] * MB))
+        print(f"Created {n_tiles} tiles in {args[0]}, run o4xp_2_xp12 there")
+
+    elif what == "suite":
+        if len(args) > 0 or compressor not in ["builtin", "7zip"]:
+            usage()
+        if any(e not in ["dsf_tool", "native"] for e in engines):
+            usage()
+
+        logging.basicConfig(level=logging.ERROR)
+        results = suite(runs or 3, sizes, n_tiles, workers, engines, compressor)
+        if json_name is not None:
+            with open(json_name, "w") as f:
+                json.dump(results, f, indent=1)
+
+        if baseline is not None:
+            with open(baseline, "r") as f:
+                regressions = compare(results, json.load(f), tolerance)
+            for r in regressions:
+                print(f"REGRESSION {r}")
+            if len(regressions) > 0:
+                sys.exit(1)
+
+    else:
+        usage()
+
+
+if __name__ == "__main__":
+    main()
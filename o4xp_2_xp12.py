@@ -22,177 +22,2362 @@
 
 VERSION = "--TAG--"
 
-import tempfile
 import platform, sys, os, os.path, time, shlex, subprocess, shutil, re, threading
-from queue import Queue, Empty
+import hashlib, lzma, struct, zlib, json, contextlib, glob, io
+import heapq, itertools, math, fnmatch, collections
+from queue import Queue, PriorityQueue, Empty
 import configparser
 import logging
 
 log = logging.getLogger("o4xp_2_xp12")
 
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+# configuration, set up by main()
+xp12_root = None
+work_dir = None
+dsf_tool = None
+engine = "dsf_tool"
+cmd_7zip = None
+RASTER_INCLUDE = "spr*, sum*, fal*, win*, soundscape, elevation"
+
+
+def compile_include(include):
+    """Compile comma separated shell style patterns to one regex"""
+    patterns = [p.strip() for p in include.split(",") if p.strip() != ""]
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns) or "(?!)")
+
+
+raster_include = RASTER_INCLUDE
+raster_re = compile_include(RASTER_INCLUDE)
+raster_synthesize = None  # "nearest" or "bilinear" resampling of neighbours for missing XP12 DSFs
+
+
+class RasterCache:
+    """Persistent cache of the RASTER_ lines and .raw files extracted from XP12 DSFs.
+
+    Entries are keyed on path + size + mtime of the XP12 DSF and live in
+    subdirectories of cache_dir. The RASTER_DATA lines of an entry point
+    to the .raw files within the entry so they can be fed to text2dsf as is.
+    The mtime of an entry directory is its LRU timestamp.
+    """
+
+    LINES = "rasters.txt"
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size  # bytes
+        self._lock = threading.Lock()
+        self._pinned = {}  # key -> refcount, pinned entries are not evicted
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, xp12_dsf, variant=""):
+        """Key of xp12_dsf, variant distinguishes different selections of rasters"""
+        st = os.stat(xp12_dsf)
+        id = f"{os.path.normcase(os.path.abspath(xp12_dsf))}|{st.st_size}|{st.st_mtime_ns}|{variant}"
+        return hashlib.sha1(id.encode()).hexdigest()
+
+    def _pin(self, key):
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def release(self, key):
+        with self._lock:
+            n = self._pinned.get(key, 0) - 1
+            if n > 0:
+                self._pinned[key] = n
+            else:
+                self._pinned.pop(key, None)
+
+    def lookup(self, key):
+        """Return the cached RASTER_ lines and pin the entry or None"""
+        entry = os.path.join(self.cache_dir, key)
+        self._pin(key)
+        try:
+            with open(os.path.join(entry, self.LINES), "r") as f:
+                lines = f.readlines()
+            os.utime(entry)  # LRU
+        except OSError:
+            self.release(key)
+            return None
 
-class Dsf:
+        return lines
+
+    def store(self, key, lines, txt_name):
+        """Move the .raw files referenced by lines into a new entry.
+
+        txt_name is the text file dsf_tool used as prefix for the .raw files.
+        Returns the rewritten lines, the entry is pinned.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        entry_tmp = f"{entry}.tmp-{os.getpid()}-{threading.get_ident()}"
+        os.makedirs(entry_tmp, exist_ok=True)
+        prefix_len = len(os.path.basename(txt_name)) + 1
+
+        out = []
+        for l in lines:
+            if l.startswith("RASTER_DATA"):
+                # RASTER_DATA version= bpp= flags= width= height= scale= offset= filename
+                words = l.rstrip("\r\n").split(" ", 8)
+                raw_name = os.path.basename(words[8])[prefix_len:]
+                # may be on a RAM disk
+                shutil.move(words[8], os.path.join(entry_tmp, raw_name))
+                words[8] = os.path.join(entry, raw_name)
+                l = " ".join(words) + "\n"
+            out.append(l)
+
+        with open(os.path.join(entry_tmp, self.LINES), "w") as f:
+            f.writelines(out)
+
+        self._pin(key)
+        try:
+            os.rename(entry_tmp, entry)
+        except OSError:
+            # another worker was faster, use its entry
+            shutil.rmtree(entry_tmp, ignore_errors=True)
+
+        self.evict()
+        return out
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                if not e.is_dir() or ".tmp-" in e.name:
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(e.path))
+                entries.append((e.stat().st_mtime, size, e))
+                total += size
+
+        entries.sort(key=lambda x: x[0])
+        for _, size, e in entries:
+            if total <= self.max_size:
+                break
+            with self._lock:
+                if e.name in self._pinned:
+                    continue
+            shutil.rmtree(e.path, ignore_errors=True)
+            total -= size
+            log.info(f"raster cache: evicted {e.name}")
+
+
+raster_cache = None
+
+
+class DsfTxtScan:
+    """Single streaming pass over a dsf2text dump.
+
+    Reads the file in chunks of CHUNK_SIZE so memory does not depend on
+    the size of the dump and collects:
+        has_mesh    dump contains PATCH_VERTEX lines
+        has_raster  dump contains RASTER_ lines
+        rasters     the RASTER_ lines
+
+    With rasters_only reading stops as soon as every RASTER_DEF has its
+    RASTER_DATA, they are at the start of the dump, before the mesh.
+    """
+
+    CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, fname, rasters_only=False):
+        self.fname = fname
+        self.has_mesh = False
+        self.has_raster = False
+        self.rasters = []
+        self._n_def = 0
+        self._n_data = 0
+
+        with open(fname, "rb") as f:
+            tail = b""  # incomplete last line of previous chunk
+            while True:
+                chunk = f.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                buf = tail + chunk
+                end = buf.rfind(b"\n") + 1
+                tail = buf[end:]
+                self._scan(buf, end)
+                if rasters_only and 0 < self._n_def <= self._n_data:
+                    return
+
+        if len(tail) > 0:
+            self._scan(tail, len(tail))
+
+    def _scan(self, buf, end):
+        """Scan buf[0:end], buf starts at a line boundary"""
+        if not self.has_mesh and buf.find(b"PATCH_VERTEX", 0, end) >= 0:
+            self.has_mesh = True
+
+        i = 0 if buf.startswith(b"RASTER_") else buf.find(b"\nRASTER_", 0, end)
+        while i >= 0 and i < end:
+            if buf[i] == 0x0A:  # skip \n
+                i += 1
+            j = buf.find(b"\n", i, end)
+            j = end if j < 0 else j + 1
+            self.rasters.append(buf[i:j].decode().rstrip("\r\n") + "\n")
+            self.has_raster = True
+            if buf.startswith(b"RASTER_DEF", i):
+                self._n_def += 1
+            elif buf.startswith(b"RASTER_DATA", i):
+                self._n_data += 1
+            i = buf.find(b"\nRASTER_", j - 1, end)
+
+
+
+def free_memory():
+    """Available physical memory in bytes or None if unknown"""
+    if platform.system() == "Windows":
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ("dwLength", ctypes.c_ulong),
+                ("dwMemoryLoad", ctypes.c_ulong),
+                ("ullTotalPhys", ctypes.c_ulonglong),
+                ("ullAvailPhys", ctypes.c_ulonglong),
+                ("ullTotalPageFile", ctypes.c_ulonglong),
+                ("ullAvailPageFile", ctypes.c_ulonglong),
+                ("ullTotalVirtual", ctypes.c_ulonglong),
+                ("ullAvailVirtual", ctypes.c_ulonglong),
+                ("sullAvailExtendedVirtual", ctypes.c_ulonglong),
+            ]
+
+        ms = MEMORYSTATUSEX()
+        ms.dwLength = ctypes.sizeof(ms)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(ms)):
+            return ms.ullAvailPhys
+        return None
+
+    try:
+        with open("/proc/meminfo") as f:
+            for l in f:
+                if l.startswith("MemAvailable:"):
+                    return int(l.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+class Admission:
+    """Admission control of conversion jobs against RAM and temp disk budgets.
+
+    The cost of a job is estimated from the size of the ortho DSF. A job is
+    started only if its cost fits into what is left of the budgets and into
+    the currently free memory / free space on work_dir. A job is always
+    admitted if nothing else is running, so huge tiles can't starve.
+    A budget of 0 means unlimited.
+    """
+
+    # text dump, .raw files, new DSF relative to the (compressed) DSF size
+    DISK_FACTOR = 25
+    DISK_EXTRA = 64 * 1024 * 1024
+    # dsf_tool holds the whole mesh
+    RAM_FACTOR = 10
+    RAM_EXTRA = 256 * 1024 * 1024
+
+    def __init__(self, max_ram, max_tmp_disk, work_dir):
+        self.max_ram = max_ram
+        self.max_tmp_disk = max_tmp_disk
+        self.work_dir = work_dir
+        self.ram = 0  # reserved by running jobs
+        self.disk = 0
+        self._running = {}  # dsf -> (ram, disk)
+        self._cond = threading.Condition()
+
+    def estimate(self, dsf):
+        size = dsf.size  # 0 if the DSF is missing, decode then fails the job
+        return (
+            self.RAM_FACTOR * size + self.RAM_EXTRA,
+            self.DISK_FACTOR * size + self.DISK_EXTRA,
+        )
+
+    def _fits(self, ram, disk):
+        if len(self._running) == 0:
+            return True
+
+        if self.max_ram > 0 and self.ram + ram > self.max_ram:
+            return False
+
+        if self.max_tmp_disk > 0 and self.disk + disk > self.max_tmp_disk:
+            return False
+
+        # reserved but not yet used memory/disk is not reflected in the free values
+        # so this is on the optimistic side
+        mem = free_memory()
+        if mem is not None and ram > mem:
+            return False
+
+        if disk > shutil.disk_usage(self.work_dir).free:
+            return False
+
+        return True
+
+    def acquire(self, dsf):
+        ram, disk = self.estimate(dsf)
+        with self._cond:
+            while not self._fits(ram, disk):
+                self._cond.wait(timeout=5)  # free memory/disk may change anytime
+
+            self._running[dsf] = (ram, disk)
+            self.ram += ram
+            self.disk += disk
+
+    def release(self, dsf):
+        with self._cond:
+            if dsf not in self._running:
+                return
+
+            ram, disk = self._running.pop(dsf)
+            self.ram -= ram
+            self.disk -= disk
+            self._cond.notify_all()
+
+
+class ScratchTiers:
+    """Placement of the intermediate files of conversion jobs.
+
+    A job uses the RAM backed ram_dir (e.g. /dev/shm) if its estimated
+    intermediates fit into what is left of the budget and into the free space
+    of ram_dir, otherwise it spills over to work_dir on disk.
+    """
+
+    def __init__(self, ram_dir, max_ram_dir, work_dir):
+        self.ram_dir = ram_dir
+        self.max_ram_dir = max_ram_dir
+        self.work_dir = work_dir
+        self.used = 0  # reserved by jobs in ram_dir
+        self._placed = {}  # dsf -> reserved size
+        self._lock = threading.Lock()
+
+    def estimate(self, dsf):
+        return Admission.DISK_FACTOR * os.path.getsize(dsf.fname)
+
+    def place(self, dsf):
+        """Return the directory for the intermediate files of dsf"""
+        size = self.estimate(dsf)
+        with self._lock:
+            if (
+                self.used + size <= self.max_ram_dir
+                and size < shutil.disk_usage(self.ram_dir).free
+            ):
+                self._placed[dsf] = size
+                self.used += size
+                return self.ram_dir
+
+        return self.work_dir
+
+    def release(self, dsf):
+        with self._lock:
+            self.used -= self._placed.pop(dsf, 0)
+
+
+def _7z_number(v):
+    """7z variable length encoding of v"""
+    for n in range(8):
+        if v < (1 << (7 * (n + 1))):
+            first = ((0xFF << (8 - n)) & 0xFF) | (v >> (8 * n))
+            return bytes([first]) + (v & ((1 << (8 * n)) - 1)).to_bytes(n, "little")
+
+    return b"\xff" + v.to_bytes(8, "little")
+
+
+def write_7z(src, dst, name, chunk_size=4 * 1024 * 1024):
+    """Compress file src into a single file 7z archive dst, method LZMA.
+
+    This is what "7z a -t7z -m0=lzma" produces, the compression is streamed
+    through the standard library's lzma module in chunks of chunk_size.
+    """
+    lc, lp, pb, dict_size = 3, 0, 2, 16 * 1024 * 1024
+    comp = lzma.LZMACompressor(
+        format=lzma.FORMAT_RAW,
+        filters=[
+            {
+                "id": lzma.FILTER_LZMA1,
+                "preset": 6,
+                "dict_size": dict_size,
+                "lc": lc,
+                "lp": lp,
+                "pb": pb,
+            }
+        ],
+    )
+
+    crc = 0
+    unpack_size = 0
+    pack_size = 0
+    with open(src, "rb") as fi, open(dst, "wb") as fo:
+        fo.write(bytes(32))  # start header, written at the end
+        while True:
+            data = fi.read(chunk_size)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            unpack_size += len(data)
+            packed = comp.compress(data)
+            pack_size += len(packed)
+            fo.write(packed)
+
+        packed = comp.flush()
+        pack_size += len(packed)
+        fo.write(packed)
+
+        props = bytes([(pb * 5 + lp) * 9 + lc]) + struct.pack("<I", dict_size)
+        fname = (name + "\0").encode("utf-16-le")
+        n = _7z_number
+        hdr = b"".join(
+            [
+                b"\x01",  # Header
+                b"\x04",  # MainStreamsInfo
+                b"\x06" + n(0) + n(1) + b"\x09" + n(pack_size) + b"\x00",  # PackInfo
+                b"\x07\x0b" + n(1) + b"\x00",  # UnPackInfo, Folder, 1 folder, not external
+                n(1) + b"\x23\x03\x01\x01" + n(len(props)) + props,  # 1 coder: LZMA
+                b"\x0c" + n(unpack_size),  # CodersUnPackSize
+                b"\x00",  # end of UnPackInfo
+                b"\x08\x0a\x01" + struct.pack("<I", crc),  # SubStreamsInfo, CRC, all defined
+                b"\x00",  # end of SubStreamsInfo
+                b"\x00",  # end of MainStreamsInfo
+                b"\x05" + n(1),  # FilesInfo, 1 file
+                b"\x11" + n(len(fname) + 1) + b"\x00" + fname,  # Name, not external
+                b"\x00",  # end of FilesInfo
+                b"\x00",  # end of Header
+            ]
+        )
+        fo.write(hdr)
+
+        next_hdr = struct.pack("<QQI", pack_size, len(hdr), zlib.crc32(hdr))
+        fo.seek(0)
+        fo.write(b"7z\xbc\xaf\x27\x1c\x00\x04")
+        fo.write(struct.pack("<I", zlib.crc32(next_hdr)) + next_hdr)
+
+
+class _7zHeaderReader:
+    """Reader for the property encoded 7z header"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def byte(self):
+        v = self.data[self.pos]
+        self.pos += 1
+        return v
+
+    def bytes(self, n):
+        v = self.data[self.pos : self.pos + n]
+        self.pos += n
+        return v
+
+    def number(self):
+        first = self.byte()
+        mask = 0x80
+        for n in range(8):
+            if first & mask == 0:
+                high = first & (mask - 1)
+                return int.from_bytes(self.bytes(n), "little") | (high << (8 * n))
+            mask >>= 1
+
+        return int.from_bytes(self.bytes(8), "little")
+
+    def skip_digests(self, n):
+        all_defined = self.byte()
+        if all_defined == 0:
+            defined = int.from_bytes(self.bytes((n + 7) // 8), "big")
+            n = bin(defined).count("1")
+        self.pos += 4 * n
+
+    def streams_info(self):
+        """Return (pack_pos, pack_sizes, folders), folder = (coder_id, props, unpack_size)"""
+        pack_pos = 0
+        pack_sizes = []
+        folders = []
+        while True:
+            t = self.byte()
+            if t == 0x00 or t == 0x08:  # end or SubStreamsInfo which we don't need
+                break
+
+            if t == 0x06:  # PackInfo
+                pack_pos = self.number()
+                n = self.number()
+                while True:
+                    t = self.byte()
+                    if t == 0x00:
+                        break
+                    if t == 0x09:
+                        pack_sizes = [self.number() for _ in range(n)]
+                    elif t == 0x0A:
+                        self.skip_digests(n)
+                    else:
+                        self.pos += self.number()
+
+            elif t == 0x07:  # UnPackInfo
+                assert self.byte() == 0x0B, "7z: folder expected"
+                num_folders = self.number()
+                assert self.byte() == 0, "7z: external folders are not supported"
+                for _ in range(num_folders):
+                    num_coders = self.number()
+                    assert num_coders == 1, "7z: only single coder folders are supported"
+                    flag = self.byte()
+                    coder_id = bytes(self.bytes(flag & 0x0F))
+                    assert flag & 0x10 == 0, "7z: complex coders are not supported"
+                    props = bytes(self.bytes(self.number())) if flag & 0x20 else b""
+                    folders.append([coder_id, props, 0])
+
+                assert self.byte() == 0x0C, "7z: unpack sizes expected"
+                for f in folders:
+                    f[2] = self.number()
+
+                while True:
+                    t = self.byte()
+                    if t == 0x00:
+                        break
+                    if t == 0x0A:
+                        self.skip_digests(num_folders)
+                    else:
+                        self.pos += self.number()
+            else:
+                raise ValueError(f"7z: unexpected property {t}")
+
+        return (pack_pos, pack_sizes, folders)
+
+
+def _7z_filter(folder):
+    """Return the lzma filter for folder, None for copy"""
+    coder_id, props, unpack_size = folder
+    if coder_id == b"\x00":  # copy
+        return None
+
+    if coder_id == b"\x03\x01\x01":  # LZMA
+        d = props[0]
+        filter = {
+            "id": lzma.FILTER_LZMA1,
+            "lc": d % 9,
+            "lp": (d // 9) % 5,
+            "pb": d // 45,
+            "dict_size": struct.unpack("<I", props[1:5])[0],
+        }
+    elif coder_id == b"\x21":  # LZMA2
+        d = props[0]
+        dict_size = 0xFFFFFFFF if d == 40 else (2 | (d & 1)) << (d // 2 + 11)
+        filter = {"id": lzma.FILTER_LZMA2, "dict_size": dict_size}
+    else:
+        raise ValueError(f"7z: unsupported coder {coder_id.hex()}")
+
+    return filter
+
+
+def _7z_decode(packed, folder):
+    filter = _7z_filter(folder)
+    if filter is None:
+        return bytes(packed)
+
+    dec = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=[filter])
+    return dec.decompress(packed, max_length=folder[2])
+
+
+def _7z_main_folder(f):
+    """Return (pack_pos, pack_size, folder) of the first file of the 7z archive in file f"""
+    f.seek(0)
+    start = f.read(32)
+    assert start[:6] == b"7z\xbc\xaf\x27\x1c", "7z: invalid signature"
+    next_hdr_offset, next_hdr_size = struct.unpack("<QQ", start[12:28])
+    f.seek(32 + next_hdr_offset)
+    r = _7zHeaderReader(f.read(next_hdr_size))
+
+    t = r.byte()
+    if t == 0x17:  # EncodedHeader
+        pack_pos, pack_sizes, folders = r.streams_info()
+        f.seek(32 + pack_pos)
+        r = _7zHeaderReader(_7z_decode(f.read(pack_sizes[0]), folders[0]))
+        t = r.byte()
+
+    assert t == 0x01, "7z: header expected"
+    while True:
+        t = r.byte()
+        if t == 0x02:  # ArchiveProperties
+            while r.byte() != 0:
+                r.pos += r.number()
+        elif t == 0x04:  # MainStreamsInfo
+            pack_pos, pack_sizes, folders = r.streams_info()
+            return (pack_pos, pack_sizes[0], folders[0])
+        else:
+            raise ValueError(f"7z: unexpected property {t}")
+
+
+def read_7z(data):
+    """Return the contents of the first file of 7z archive data"""
+    pack_pos, pack_size, folder = _7z_main_folder(io.BytesIO(data))
+    return _7z_decode(data[32 + pack_pos : 32 + pack_pos + pack_size], folder)
+
+
+class _7zStream:
+    """Sequential reads of the first file of a 7z archive, decompressing only what is read"""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, f):
+        self.f = f
+        pack_pos, self.left, folder = _7z_main_folder(f)
+        f.seek(32 + pack_pos)
+        filter = _7z_filter(folder)
+        self.dec = None
+        if filter is not None:
+            self.dec = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=[filter])
+        self.buf = b""
+
+    def read(self, n):
+        while len(self.buf) < n:
+            if self.dec is not None and self.dec.eof:
+                break
+
+            if self.dec is not None and not self.dec.needs_input:
+                chunk = b""
+            elif self.left > 0:
+                chunk = self.f.read(min(self.CHUNK_SIZE, self.left))
+                if not chunk:
+                    break
+                self.left -= len(chunk)
+            else:
+                break
+
+            if self.dec is None:
+                self.buf += chunk
+            else:
+                self.buf += self.dec.decompress(chunk, max_length=n - len(self.buf))
+
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+
+class DsfAtoms:
+    """Atom level access to a DSF file.
+
+    A DSF is "XPLNEDSF", int32 version, a sequence of atoms and a MD5 footer.
+    An atom is int32 id, int32 size including the 8 byte atom header and the
+    payload. Ids are 4 character codes, e.g. "HEAD", stored as little endian
+    int32 so they appear reversed in the file.
+    Payloads are kept as memoryviews of the file's data and written back as is.
+    """
+
+    MAGIC = b"XPLNEDSF"
+    HEAD_ATOMS = ["HEAD", "DEFN"]
+
+    def __init__(self, data):
+        data = memoryview(data)
+        assert data[:8] == self.MAGIC, "not a DSF"
+        self.version = struct.unpack("<i", data[8:12])[0]
+        self.atoms = self.parse_atoms(data[12:-16])  # list of [id, payload]
+        self.partial = False
+
+    @classmethod
+    def read(cls, fname):
+        with open(fname, "rb") as f:
+            data = f.read()
+        if data[:6] == b"7z\xbc\xaf\x27\x1c":
+            data = read_7z(data)
+        return cls(data)
+
+    @classmethod
+    def read_head(cls, fname):
+        """Read only the HEAD and DEFN atoms at the start of the DSF.
+
+        That's enough for has_mesh() and has_raster(). Of a 7z compressed DSF
+        only the beginning is decompressed.
+        """
+        with open(fname, "rb") as f:
+            read = f.read
+            if f.read(6) == b"7z\xbc\xaf\x27\x1c":
+                read = _7zStream(f).read
+            else:
+                f.seek(0)
+
+            data = read(12)
+            assert data[:8] == cls.MAGIC, "not a DSF"
+            self = cls.__new__(cls)
+            self.version = struct.unpack("<i", data[8:12])[0]
+            self.atoms = []
+            self.partial = True
+            while True:
+                hdr = read(8)
+                if len(hdr) < 8:
+                    break
+
+                id, size = struct.unpack("<4sI", hdr)
+                id = id[::-1].decode(errors="replace")
+                if id not in cls.HEAD_ATOMS or size < 8:
+                    break
+
+                payload = read(size - 8)
+                assert len(payload) == size - 8, "DSF: truncated atom"
+                self.atoms.append([id, memoryview(payload)])
+                if id == cls.HEAD_ATOMS[-1]:
+                    break
+
+        return self
+
+    @staticmethod
+    def parse_atoms(data):
+        atoms = []
+        pos = 0
+        while pos + 8 <= len(data):
+            id, size = struct.unpack("<4sI", data[pos : pos + 8])
+            assert size >= 8 and pos + size <= len(data), "DSF: invalid atom"
+            atoms.append([id[::-1].decode(), data[pos + 8 : pos + size]])
+            pos += size
+
+        return atoms
+
+    @staticmethod
+    def atom_bytes(id, payload):
+        return struct.pack("<4sI", id[::-1].encode(), len(payload) + 8)
+
+    def get(self, id, atoms=None):
+        for a_id, payload in self.atoms if atoms is None else atoms:
+            if a_id == id:
+                return payload
+
+        return None
+
+    def get_sub(self, id, sub_id):
+        payload = self.get(id)
+        if payload is None:
+            return None
+
+        return self.get(sub_id, self.parse_atoms(payload))
+
+    @staticmethod
+    def string_table(payload):
+        return [s.decode() for s in bytes(payload).split(b"\0")[:-1]]
+
+    def has_mesh(self):
+        tert = self.get_sub("DEFN", "TERT")
+        return (
+            tert is not None
+            and len(tert) > 0
+            and (self.partial or self.get("CMDS") is not None)
+        )
+
+    def has_raster(self):
+        return self.get("DEMS") is not None or self.get_sub("DEFN", "DEMN") is not None
+
+    def rasters(self):
+        """Return list of (name, DEMI payload, DEMD payload)"""
+        demn = self.get_sub("DEFN", "DEMN")
+        dems = self.get("DEMS")
+        if demn is None or dems is None:
+            return []
+
+        names = self.string_table(demn)
+        sub = self.parse_atoms(dems)
+        demi = [p for id, p in sub if id == "DEMI"]
+        demd = [p for id, p in sub if id == "DEMD"]
+        assert len(names) == len(demi) == len(demd), "DSF: inconsistent rasters"
+        return list(zip(names, demi, demd))
+
+    def set_rasters(self, rasters):
+        """Replace raster atoms by rasters = list of (name, DEMI payload, DEMD payload)"""
+        defn = [
+            [id, p] for id, p in self.parse_atoms(self.get("DEFN")) if id != "DEMN"
+        ]
+        defn.append(["DEMN", b"".join(n.encode() + b"\0" for n, _, _ in rasters)])
+        dems = []
+        for _, demi, demd in rasters:
+            dems.append(self.atom_bytes("DEMI", demi) + bytes(demi))
+            dems.append(self.atom_bytes("DEMD", demd) + bytes(demd))
+
+        atoms = []
+        for id, p in self.atoms:
+            if id == "DEMS":
+                continue
+            if id == "DEFN":
+                p = b"".join(self.atom_bytes(i, sp) + bytes(sp) for i, sp in defn)
+            if id == "CMDS":  # DEMS goes in front of the commands as X-Plane does it
+                atoms.append(["DEMS", b"".join(dems)])
+            atoms.append([id, p])
+
+        self.atoms = atoms
+
+    def write(self, fname):
+        md5 = hashlib.md5()
+        with open(fname, "wb") as f:
+
+            def out(b):
+                md5.update(b)
+                f.write(b)
+
+            out(self.MAGIC + struct.pack("<i", self.version))
+            for id, payload in self.atoms:
+                out(self.atom_bytes(id, payload))
+                out(payload)
+
+            f.write(md5.digest())
+
+
+class TileIndex:
+    """Persistent SQLite index of the DSF files below ortho_dir.
+
+    Records path, lat/lon, size, mtime and conversion state of each tile and
+    the result of the preflight check of its DSF head ("" = ok), which is kept
+    while size and mtime are unchanged.
+    A directory is only listed again if its mtime changed, unchanged
+    directories are answered from the index. Directories are processed
+    in parallel by a thread pool which helps on high latency network drives.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY, mtime_ns INTEGER, subdirs TEXT);
+        CREATE TABLE IF NOT EXISTS tiles (
+            path TEXT PRIMARY KEY, dir TEXT, lat INTEGER, lon INTEGER,
+            size INTEGER, mtime_ns INTEGER, is_converted INTEGER, has_backup INTEGER,
+            head TEXT);
+        CREATE INDEX IF NOT EXISTS tiles_dir ON tiles(dir);
+        CREATE INDEX IF NOT EXISTS tiles_lat_lon ON tiles(lat, lon);
+    """
+
+    def __init__(self, db_name, num_threads=16):
+        self.db_name = db_name
+        self.num_threads = num_threads
+        import sqlite3
+
+        self.db = sqlite3.connect(db_name)
+        self.db.executescript(self.SCHEMA)
+        if "head" not in [c[1] for c in self.db.execute("PRAGMA table_info(tiles)")]:
+            self.db.execute("ALTER TABLE tiles ADD COLUMN head TEXT")  # index of an older version
+        self.db.create_function(
+            "REGEXP", 2, lambda r, s: re.search(r, s) is not None, deterministic=True
+        )
+        self._lat_lon_re = re.compile(r"([+-]\d\d)([+-]\d\d\d)\.dsf$")
+
+    def _scan_dir(self, dir, known):
+        """List dir if its mtime differs from known = (mtime_ns, subdirs) or None.
+
+        Returns (dir, mtime_ns, subdirs, tiles), tiles is None for an unchanged dir.
+        """
+        try:
+            mtime_ns = os.stat(dir).st_mtime_ns
+        except OSError:
+            return (dir, None, [], [])
+
+        if known is not None and known[0] == mtime_ns:
+            return (dir, mtime_ns, known[1], None)
+
+        subdirs = []
+        dsfs = []
+        names = set()
+        with os.scandir(dir) as it:
+            for e in it:
+                names.add(e.name)
+                if e.is_dir():  # follows links as os.walk(followlinks=True)
+                    subdirs.append(e.path)
+                elif e.name.endswith(".dsf"):
+                    dsfs.append(e)
+
+        tiles = []
+        for e in dsfs:
+            st = e.stat()
+            m = self._lat_lon_re.search(e.name)
+            lat, lon = (int(m.group(1)), int(m.group(2))) if m else (None, None)
+            tiles.append(
+                (
+                    e.path,
+                    dir,
+                    lat,
+                    lon,
+                    st.st_size,
+                    st.st_mtime_ns,
+                    e.name + "-o4xp_2_xp12_done" in names,
+                    e.name + "-pre_o4xp_2_xp12" in names,
+                )
+            )
+
+        return (dir, mtime_ns, subdirs, tiles)
+
+    def refresh(self, root, full=False):
+        """Bring the index up to date for the tree below root"""
+        start_time = time.time()
+        known = {}
+        if not full:
+            for path, mtime_ns, subdirs in self.db.execute(
+                "SELECT path, mtime_ns, subdirs FROM dirs"
+            ):
+                known[path] = (mtime_ns, subdirs.split("\n") if subdirs else [])
+
+        seen = set()
+        n_changed = 0
+        pending = [root]
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as ex:
+            while len(pending) > 0:
+                seen.update(pending)
+                results = list(ex.map(lambda d: self._scan_dir(d, known.get(d)), pending))
+                pending = []
+                for dir, mtime_ns, subdirs, tiles in results:
+                    pending.extend(d for d in subdirs if d not in seen)
+                    if tiles is None:
+                        continue
+
+                    n_changed += 1
+                    heads = {
+                        (path, size, mtime_ns): head
+                        for path, size, mtime_ns, head in self.db.execute(
+                            "SELECT path, size, mtime_ns, head FROM tiles WHERE dir = ?", (dir,)
+                        )
+                    }
+                    self.db.execute("DELETE FROM tiles WHERE dir = ?", (dir,))
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [t + (heads.get((t[0], t[4], t[5])),) for t in tiles],
+                    )
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                        (dir, mtime_ns, "\n".join(subdirs)),
+                    )
+
+        # directories that vanished
+        for dir in known.keys() - seen:
+            if dir.startswith(root):
+                self.db.execute("DELETE FROM tiles WHERE dir = ?", (dir,))
+                self.db.execute("DELETE FROM dirs WHERE path = ?", (dir,))
+
+        self.db.commit()
+        log.info(
+            f"tile index: {len(seen)} directories, {n_changed} rescanned"
+            f" in {time.time() - start_time:0.1f} seconds"
+        )
+
+    def select(self, root, dir_re, subset, rect):
+        """Yield (path, is_converted, has_backup, head) of matching tiles"""
+        sql = "SELECT path, is_converted, has_backup, head FROM tiles WHERE instr(path, ?) = 1 AND dir REGEXP ?"
+        args = [root, dir_re]
+        if subset is not None:
+            sql += " AND instr(path, ?) > 0"
+            args.append(subset)
+
+        if rect is not None:
+            sql += " AND lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?"
+            lat1, lon1, lat2, lon2 = rect
+            args.extend([lat1, lat2, lon1, lon2])
+
+        yield from self.db.execute(sql + " ORDER BY path", args)
+
+    def set_heads(self, heads):
+        """Store the results of head checks, heads = [(head, path)]"""
+        self.db.executemany("UPDATE tiles SET head = ? WHERE path = ?", heads)
+        self.db.commit()
+
+
+class RunReport:
+    """Per tile and stage measurements of a run.
+
+    Records are written to a JSONL file as they come in and summarized
+    with percentiles per stage at the end of the run.
+    """
 
     def __init__(self, fname):
+        self.fname = fname
+        self.records = []
+        self._lock = threading.Lock()
+        self._f = open(fname, "w") if fname else None
+
+    def add(self, rec):
+        with self._lock:
+            self.records.append(rec)
+            if self._f is not None:
+                self._f.write(json.dumps(rec) + "\n")
+                self._f.flush()
+
+    @staticmethod
+    def percentile(values, p):
+        """nearest rank percentile of sorted values"""
+        k = max(0, min(len(values) - 1, math.ceil(p * len(values) / 100) - 1))
+        return values[k]
+
+    def summary(self):
+        by_stage = {}
+        for r in self.records:
+            by_stage.setdefault(r["stage"], []).append(r)
+
+        if len(by_stage) == 0:
+            return
+
+        log.info(
+            f"{'stage':<14}{'n':>6}{'wall s':>10}{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}"
+            f"{'cpu s':>10}{'rss MB':>8}{'MB in':>10}{'MB out':>10}{'MB/s':>8}"
+        )
+        for stage, recs in by_stage.items():
+            wall = sorted(r["wall"] for r in recs)
+            total = sum(wall)
+            mb_in = sum(r["bytes_in"] for r in recs) / 1024 / 1024
+            mb_out = sum(r["bytes_out"] for r in recs) / 1024 / 1024
+            p = lambda x: f"{self.percentile(wall, x):8.1f}"
+            log.info(
+                f"{stage:<14}{len(recs):6d}{total:10.1f}{p(50)}{p(90)}{p(99)}{wall[-1]:8.1f}"
+                f"{sum(r['cpu_children'] for r in recs):10.1f}"
+                f"{max(r['maxrss_children'] for r in recs) / 1024 / 1024:8.0f}"
+                f"{mb_in:10.1f}{mb_out:10.1f}{(mb_in + mb_out) / max(total, 1e-3):8.1f}"
+            )
+
+        if resource is not None:
+            log.info(f"peak RSS of o4xp_2_xp12: {maxrss(resource.RUSAGE_SELF) / 1024 / 1024:0.0f} MB")
+        if self._f is not None:
+            log.info(f"stage report written to {self.fname}")
+
+
+def maxrss(who=None, ru=None):
+    """ru_maxrss in bytes"""
+    if ru is None:
+        ru = resource.getrusage(who)
+    return ru.ru_maxrss * (1 if platform.system() == "Darwin" else 1024)
+
+
+run_report = None
+
+
+class JobJournal:
+    """Write-ahead journal of the state transitions of conversion jobs.
+
+    One JSON line {"tile": fname, "state": state} per transition:
+        queued -> decoding -> encoding -> compressing -> swapping -> swapped -> done
+    or failed from any state. "swapping" also carries the source fingerprint and
+    the XP12 DSF, so a recovered tile gets a complete marker. At startup the
+    journal is replayed, tiles caught in an unfinished state are recovered or
+    cleaned up (Dsf.recover) and the journal is compacted to the unfinished
+    tiles, which -resume queues again.
+
+    The journal and the temporary files in work_dir belong to one process, an
+    exclusive lock on fname + ".lock" keeps a second one out for the whole run.
+    """
+
+    FINAL = ["done", "failed"]
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock_f = open(fname + ".lock", "a")
+        try:
+            if platform.system() == "Windows":
+                import msvcrt
+
+                self._lock_f.seek(0)
+                msvcrt.locking(self._lock_f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+
+                fcntl.flock(self._lock_f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_f.close()
+            raise RuntimeError(f"{os.path.dirname(fname)} is in use by another o4xp_2_xp12")
+
+        self._lock = threading.Lock()
+        self.unfinished = {}  # tile -> last state of previous runs
+        self.data = {}  # tile -> extra data of the last record that had some
+        try:
+            with open(fname, "r") as f:
+                for l in f:
+                    try:
+                        r = json.loads(l)
+                    except ValueError:
+                        continue  # torn last line
+                    if r["state"] in self.FINAL:
+                        self.unfinished.pop(r["tile"], None)
+                        self.data.pop(r["tile"], None)
+                    else:
+                        self.unfinished[r["tile"]] = r["state"]
+                        if "data" in r:
+                            self.data[r["tile"]] = r["data"]
+        except OSError:
+            pass
+
+        self._f = None
+
+    def recover(self):
+        """Recover tiles of a previous run, compact the journal to the ones left to do"""
+        for tile, state in list(self.unfinished.items()):
+            if state != "queued":
+                log.info(f"journal: recovering {tile} from state '{state}'")
+            if Dsf(tile).recover(state, self.data.get(tile, {})):
+                del self.unfinished[tile]
+            else:
+                self.unfinished[tile] = "queued"
+
+        # stale temporary raster cache entries of crashed runs
+        if raster_cache is not None:
+            for d in glob.glob(os.path.join(raster_cache.cache_dir, "*.tmp-*")):
+                if time.time() - os.path.getmtime(d) > 3600:
+                    shutil.rmtree(d, ignore_errors=True)
+
+        tmp = self.fname + ".tmp"
+        with open(tmp, "w") as f:
+            for tile, state in self.unfinished.items():
+                f.write(json.dumps({"tile": tile, "state": state}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fname)
+        self._f = open(self.fname, "a")
+        log.info(f"journal: {len(self.unfinished)} unfinished tiles from previous runs")
+
+    def record(self, tile, state, sync=False, data=None):
+        r = {"tile": tile, "state": state}
+        if data is not None:
+            r["data"] = data
+        with self._lock:
+            self._f.write(json.dumps(r) + "\n")
+            self._f.flush()
+            if sync:
+                os.fsync(self._f.fileno())
+
+
+journal = None
+scratch = None
+
+
+def airport_lat_lon(xp12_root, icao):
+    """Return (lat, lon) of airport icao from XP12's apt.dat or None"""
+    apt_dat = os.path.join(
+        xp12_root, "Global Scenery", "Global Airports", "Earth nav data", "apt.dat"
+    )
+    found = False
+    lat = lon = None
+    with open(apt_dat, "r", encoding="utf-8", errors="replace") as f:
+        for l in f:
+            w = l.split()
+            if len(w) == 0:
+                continue
+
+            if w[0] in ["1", "16", "17"]:  # airport, seaplane base, heliport header
+                if found:
+                    break
+                found = len(w) > 4 and w[4] == icao
+            elif not found:
+                continue
+            elif w[0] == "1302" and len(w) > 2:
+                if w[1] == "datum_lat":
+                    lat = float(w[2])
+                elif w[1] == "datum_lon":
+                    lon = float(w[2])
+            elif w[0] == "100" and lat is None and len(w) > 10:
+                # no datum, use the first runway end
+                lat, lon = float(w[9]), float(w[10])
+
+    if lat is None or lon is None:
+        return None
+
+    return (lat, lon)
+
+
+class DsfQueue(PriorityQueue):
+    """PriorityQueue of Dsf ordered by key(dsf), FIFO for equal keys"""
+
+    def __init__(self, key):
+        self._key = key
+        self._seq = itertools.count()
+        super().__init__()
+
+    def _put(self, dsf):
+        heapq.heappush(self.queue, (self._key(dsf), next(self._seq), dsf))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+
+class SharedQueue:
+    """Work queue in a directory shared by several hosts, e.g. on SMB or NFS.
+
+    Every job is a small JSON file that moves through the subdirectories
+    pending -> claimed -> done|failed by os.rename, which is atomic on network
+    file systems too, so exactly one worker gets a job. Tiles are stored
+    relative to ortho_dir, each host maps them to its own ortho_dir.
+    Workers touch their claimed jobs every HEARTBEAT seconds, claims older
+    than STALE seconds are left over from dead workers and are requeued.
+    pending is listed once per batch of claims, not per job, and qsize() is
+    counted at most every QSIZE_AGE seconds. Job names start with the publish
+    sequence number, so claiming in name order keeps the order of the queue.
+    """
+
+    DIRS = ["pending", "claimed", "done", "failed"]
+    HEARTBEAT = 60
+    STALE = 600
+    QSIZE_AGE = 10
+
+    def __init__(self, queue_dir, ortho_dir, mode):
+        self.queue_dir = queue_dir
+        self.ortho_dir = ortho_dir
+        self.mode = mode
+        self.worker_id = f"{platform.node()}-{os.getpid()}"
+        self._prefix = f"{mode}-"
+        self._claims = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._batch = collections.deque()  # pending jobs of the last listing
+        self._qsize = (0, 0.0)  # (count, time of count)
+        self._seq = itertools.count()
+        self._pending = None  # tile hash -> name of its pending job, for publish()
+        for d in self.DIRS:
+            os.makedirs(self._dir(d), exist_ok=True)
+
+    def _dir(self, name):
+        return os.path.join(self.queue_dir, name)
+
+    def _is_job(self, name):
+        return name.startswith(self._prefix) and name.endswith(".json")
+
+    def _write(self, fname, job):
+        tmp = f"{fname}.tmp-{self.worker_id}"
+        with open(tmp, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp, fname)
+
+    def publish(self, dsf):
+        rel = os.path.relpath(dsf.fname, self.ortho_dir).replace("\\", "/")
+        h = hashlib.sha1(rel.encode()).hexdigest()
+        if self._pending is None:
+            self._pending = {
+                n[:-5].rsplit("-", 1)[1]: n for n in os.listdir(self._dir("pending")) if self._is_job(n)
+            }
+
+        name = f"{self._prefix}{next(self._seq):08d}-{h}.json"
+        job = {"tile": rel, "mode": self.mode, "action": dsf.update_action}
+        self._write(os.path.join(self._dir("pending"), name), job)
+        old = self._pending.pop(h, None)
+        if old is not None and old != name:
+            # published by an earlier run, the new job has the current position
+            try:
+                os.remove(os.path.join(self._dir("pending"), old))
+            except OSError:
+                pass  # claimed meanwhile
+
+    def requeue_stale(self):
+        now = time.time()
+        for e in os.scandir(self._dir("claimed")):
+            if "@" not in e.name or now - e.stat().st_mtime < self.STALE:
+                continue
+
+            name = e.name.rsplit("@", 1)[1]
+            try:
+                os.rename(e.path, os.path.join(self._dir("pending"), name))
+                log.info(f"requeued stale job {e.name}")
+            except OSError:
+                pass  # someone else did
+
+    def _next_name(self):
+        """Next pending job of the current batch, list pending again when it's used up"""
+        with self._lock:
+            if len(self._batch) == 0:
+                names = sorted(n for n in os.listdir(self._dir("pending")) if self._is_job(n))
+                self._batch.extend(names)
+                self._qsize = (len(names), time.time())
+
+            return self._batch.popleft() if len(self._batch) > 0 else None
+
+    def get(self, block=False, timeout=None):
+        """Claim the next pending job, raise Empty if there is none"""
+        while True:
+            name = self._next_name()
+            if name is None:
+                break
+
+            claim = os.path.join(self._dir("claimed"), f"{self.worker_id}@{name}")
+            try:
+                os.rename(os.path.join(self._dir("pending"), name), claim)
+            except OSError:
+                continue  # another worker was faster
+
+            os.utime(claim)  # mtime is the heartbeat
+            with open(claim, "r") as f:
+                job = json.load(f)
+
+            dsf = Dsf(os.path.join(self.ortho_dir, job["tile"]))
+            dsf.update_action = job.get("action")
+            dsf.job = claim
+            with self._lock:
+                self._claims.add(claim)
+                self._qsize = (max(self._qsize[0] - 1, 0), self._qsize[1])
+                if self._heartbeat is None:
+                    self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+                    self._heartbeat.start()
+
+            return dsf
+
+        raise Empty
+
+    def qsize(self):
+        with self._lock:
+            n, t = self._qsize
+            if time.time() - t < self.QSIZE_AGE:
+                return n
+
+        n = sum(1 for n in os.listdir(self._dir("pending")) if self._is_job(n))
+        with self._lock:
+            self._qsize = (n, time.time())
+        return n
+
+    def complete(self, dsf, ok):
+        """Move the job of dsf to done or failed"""
+        with self._lock:
+            self._claims.discard(dsf.job)
+
+        try:
+            with open(dsf.job, "r") as f:
+                job = json.load(f)
+        except OSError:
+            log.warning(f"{dsf}: job was requeued while running")
+            return
+
+        job.update(host=self.worker_id, ok=ok, time=time.time())
+        name = os.path.basename(dsf.job).rsplit("@", 1)[1]
+        self._write(os.path.join(self._dir("done" if ok else "failed"), name), job)
+        os.remove(dsf.job)
+
+    def _beat(self):
+        while True:
+            time.sleep(self.HEARTBEAT)
+            with self._lock:
+                claims = list(self._claims)
+
+            for c in claims:
+                try:
+                    os.utime(c)
+                except OSError:
+                    pass
+
+    def status(self):
+        return {
+            d: sum(1 for n in os.listdir(self._dir(d)) if n.endswith(".json"))
+            for d in self.DIRS
+        }
+
+
+class Xp12Map:
+    """Map of tile ids '+NN+MMM' to the XP12 DSFs.
+
+    Built once per run from the 'Earth nav data' directories of the global
+    scenery and the demo areas, the demo areas take precedence. The map is
+    saved in work_dir and reused as long as the mtimes of all directories
+    it was built from are unchanged.
+    """
+
+    # later ones overlay earlier ones
+    SCENERIES = ["X-Plane 12 Global Scenery", "X-Plane 12 Demo Areas"]
+    VERSION = 1
+
+    def __init__(self, xp12_root):
+        self.xp12_root = xp12_root
+        self.tiles = {}  # tile id -> XP12 DSF
+        self.dirs = {}  # directory -> mtime_ns or None if missing
+        self.n_demo = 0
+
+    @staticmethod
+    def _mtime(dir):
+        try:
+            return os.stat(dir).st_mtime_ns
+        except OSError:
+            return None
+
+    def build(self):
+        self.tiles = {}
+        self.dirs = {}
+        tile_re = re.compile(r"([+-]\d\d[+-]\d\d\d)\.dsf$", re.IGNORECASE)
+        for scenery in self.SCENERIES:
+            end = os.path.join(self.xp12_root, "Global Scenery", scenery, "Earth nav data")
+            self.dirs[end] = self._mtime(end)
+            if self.dirs[end] is None:
+                continue
+
+            for d in sorted(os.listdir(end)):
+                dir = os.path.join(end, d)
+                if not os.path.isdir(dir):
+                    continue
+
+                self.dirs[dir] = self._mtime(dir)
+                for f in os.listdir(dir):
+                    m = tile_re.match(f)
+                    if m is not None:
+                        self.tiles[m.group(1)] = os.path.join(dir, f)
+
+        demo = os.path.join(self.xp12_root, "Global Scenery", self.SCENERIES[-1])
+        self.n_demo = sum(1 for p in self.tiles.values() if p.startswith(demo))
+
+    def load(self, fname):
+        """Load the map saved in fname, return False if there is none or it is outdated"""
+        try:
+            with open(fname, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if saved.get("version") != self.VERSION or saved.get("xp12_root") != self.xp12_root:
+            return False
+
+        for dir, mtime in saved["dirs"].items():
+            if self._mtime(dir) != mtime:
+                return False
+
+        self.tiles = saved["tiles"]
+        self.dirs = saved["dirs"]
+        self.n_demo = saved["n_demo"]
+        return True
+
+    def save(self, fname):
+        tmp = f"{fname}.tmp-{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "version": self.VERSION,
+                    "xp12_root": self.xp12_root,
+                    "n_demo": self.n_demo,
+                    "dirs": self.dirs,
+                    "tiles": self.tiles,
+                },
+                f,
+            )
+        os.replace(tmp, fname)
+
+    def setup(self, fname):
+        """Load the map from fname or build and save it"""
+        start = time.perf_counter()
+        if self.load(fname):
+            how = f"loaded from {fname}"
+        else:
+            self.build()
+            self.save(fname)
+            how = "built"
+        log.info(
+            f"XP12 map: {len(self.tiles)} tiles, {self.n_demo} of demo areas,"
+            f" {how} in {time.perf_counter() - start:0.2f} s"
+        )
+
+    def find(self, tile):
+        """Return the XP12 DSF of tile = '+NN+MMM' or None"""
+        return self.tiles.get(tile)
+
+
+xp12_map = None
+
+
+def file_fingerprint(fname, with_hash=False):
+    """path, size, mtime and optionally SHA1 of fname"""
+    st = os.stat(fname)
+    fp = {"path": fname, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if with_hash:
+        h = hashlib.sha1()
+        with open(fname, "rb") as f:
+            while True:
+                data = f.read(4 * 1024 * 1024)
+                if not data:
+                    break
+                h.update(data)
+        fp["sha1"] = h.hexdigest()
+
+    return fp
+
+
+FICLONE = 0x40049409  # Linux ioctl, share the data blocks of another file
+
+
+def clone_file(src, dst, link=True):
+    """Create dst with the contents of src, return how: "link", "reflink" or "copy".
+
+    A hardlink is safe because DSFs are never written in place, new versions
+    are swapped in with os.replace() which leaves the old inode to dst.
+    """
+    if link:
+        try:
+            os.link(src, dst)
+            return "link"
+        except OSError:
+            pass
+
+        try:
+            import fcntl
+
+            with open(src, "rb") as fs, open(dst, "wb") as fd:
+                fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+            shutil.copystat(src, dst)
+            return "reflink"
+        except (ImportError, OSError):
+            pass
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+class BackupStore:
+    """Content addressed store of the original DSFs.
+
+    An original is stored once as objects/<sha1[:2]>/<sha1>, xz compressed
+    if compress. Backups next to the tiles are hardlinks to the objects so
+    identical DSFs of several packs take the space once. An object with no
+    other link than its own is not referenced any more, gc() removes it.
+    """
+
+    XZ_MAGIC = b"\xfd7zXZ\x00"
+
+    def __init__(self, store_dir, compress):
+        self.store_dir = store_dir
+        self.compress = compress
+
+    def put(self, fname, sha1, bck):
+        """Store fname with SHA1 sha1 unless already there and link it as bck"""
+        obj = os.path.join(self.store_dir, "objects", sha1[:2], sha1)
+        # objects are never live DSFs, undo copies them out, so the name is all that counts
+        if not os.path.isfile(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            tmp = f"{obj}.{os.getpid()}-{threading.get_ident()}"
+            if self.compress:
+                with open(fname, "rb") as fin, lzma.open(tmp, "wb", preset=6) as fout:
+                    shutil.copyfileobj(fin, fout, 4 * 1024 * 1024)
+                shutil.copystat(fname, tmp)
+            else:
+                clone_file(fname, tmp)
+            os.replace(tmp, obj)  # of concurrent stores of the same DSF one wins
+
+        try:
+            os.link(obj, bck)
+        except OSError:
+            shutil.copy2(obj, bck)  # on another filesystem
+
+    @classmethod
+    def is_compressed(cls, fname):
+        with open(fname, "rb") as f:
+            return f.read(len(cls.XZ_MAGIC)) == cls.XZ_MAGIC
+
+    @staticmethod
+    def decompress(bck, dst):
+        with lzma.open(bck, "rb") as fin, open(dst, "wb") as fout:
+            shutil.copyfileobj(fin, fout, 4 * 1024 * 1024)
+        shutil.copystat(bck, dst)
+
+    def gc(self):
+        """Remove objects that are not referenced by a backup"""
+        n = size = 0
+        for dir, _, files in os.walk(os.path.join(self.store_dir, "objects")):
+            for f in files:
+                obj = os.path.join(dir, f)
+                st = os.stat(obj)
+                if st.st_nlink == 1:
+                    os.remove(obj)
+                    n += 1
+                    size += st.st_size
+
+        log.info(f"backup store: removed {n} unreferenced objects, {size / (1024 * 1024):0.1f} MB")
+
+
+# configuration of backups, set up by main()
+backup_link = True  # hardlink or reflink originals instead of copying
+backup_store = None
+
+
+class ProcRunner:
+    """Runs the external tools, all children are supervised by one asyncio
+    event loop in a background thread.
+
+    Output of a child is streamed to the log line by line, only the last
+    TAIL_LINES are kept for error messages. A child that exceeds its timeout
+    is killed. On Linux the child is watched with a pidfd and reaped with
+    os.wait4() to get its resource usage, elsewhere asyncio's subprocess
+    support is used and the resource usage is unknown.
+    Children run in their own session/process group so a Ctrl-C in the
+    terminal reaches only us, running jobs are finished or, on abort,
+    killed by kill_all().
+    """
+
+    TAIL_LINES = 20
+    if platform.system() == "Windows":
+        SPAWN = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        SPAWN = {"start_new_session": True}
+
+    def __init__(self):
+        import asyncio
+
+        self.use_pidfd = False
+        if hasattr(os, "pidfd_open"):
+            try:
+                os.close(os.pidfd_open(os.getpid()))
+                self.use_pidfd = True
+            except OSError:  # kernel < 5.3
+                pass
+
+        self._procs = set()  # running children, used by the loop only
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def run(self, args, timeout=None):
+        """Run args, return (returncode, output tail, rusage or None, timed_out)"""
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(self._run(args, timeout), self.loop).result()
+
+    def kill_all(self):
+        """Kill all running children"""
+        import asyncio
+
+        async def kill():
+            for p in self._procs:
+                try:
+                    p.kill()
+                except ProcessLookupError:
+                    pass
+
+        asyncio.run_coroutine_threadsafe(kill(), self.loop).result()
+
+    async def _run(self, args, timeout):
+        if self.use_pidfd:
+            return await self._run_pidfd(args, timeout)
+
+        return await self._run_asyncio(args, timeout)
+
+    async def _read(self, reader, name, tail):
+        while True:
+            l = await reader.readline()
+            if not l:
+                break
+
+            l = l.decode(errors="replace").rstrip("\r\n")
+            log.debug(f"{name}: {l}")
+            tail.append(l)
+
+    async def _run_pidfd(self, args, timeout):
+        import asyncio
+
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **self.SPAWN)
+        self._procs.add(p)
+        pidfd = os.pidfd_open(p.pid)
+        exited = self.loop.create_future()
+
+        def on_exit():
+            if not exited.done():
+                exited.set_result(None)
+
+        self.loop.add_reader(pidfd, on_exit)
+        reader = asyncio.StreamReader()
+        transport, _ = await self.loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), p.stdout
+        )
+
+        async def output_and_exit():
+            await self._read(reader, os.path.basename(args[0]), tail)
+            await exited
+
+        tail = collections.deque(maxlen=self.TAIL_LINES)
+        timed_out = False
+        try:
+            await asyncio.wait_for(output_and_exit(), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            p.kill()
+            await exited
+        finally:
+            self.loop.remove_reader(pidfd)
+            os.close(pidfd)
+            transport.close()
+
+        _, status, ru = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        self._procs.discard(p)
+        return (p.returncode, "\n".join(tail), ru, timed_out)
+
+    async def _run_asyncio(self, args, timeout):
+        import asyncio
+
+        p = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, **self.SPAWN
+        )
+        self._procs.add(p)
+        tail = collections.deque(maxlen=self.TAIL_LINES)
+        timed_out = False
+        try:
+            await asyncio.wait_for(self._read(p.stdout, os.path.basename(args[0]), tail), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            p.kill()
+        await p.wait()
+        self._procs.discard(p)
+        return (p.returncode, "\n".join(tail), None, timed_out)
+
+
+# configuration of the external tools, set up by main()
+tool_timeouts = {}  # stage -> seconds
+tool_retries = 1  # runs after a timeout
+proc_runner = None
+_proc_runner_lock = threading.Lock()
+aborted = threading.Event()  # second Ctrl-C, running jobs are killed and left unfinished
+
+
+def get_proc_runner():
+    global proc_runner
+    with _proc_runner_lock:
+        if proc_runner is None:
+            proc_runner = ProcRunner()
+    return proc_runner
+
+
+class Dsf:
+
+    def __init__(self, fname, is_converted=None, has_backup=None):
         self.fname = fname.replace("\\", "/")
         self.fname_bck = self.fname + "-pre_o4xp_2_xp12"
         self.cnv_marker = self.fname + "-o4xp_2_xp12_done"
         self.dsf_base, _ = os.path.splitext(os.path.basename(self.fname))
         self.rdata = []
-        self.is_converted = os.path.isfile(self.cnv_marker)
-        self.has_backup = os.path.isfile(self.fname_bck)
+        self._rc_keys = []  # pinned raster cache entries
+        self.tmp_files = []
+        self.dsf_atoms = None
+        self._records = []  # measurements of running stages
+        self.xp12_dsf = None
+        self.src_fingerprint = None
+        self.update_action = None  # for mode update: "new", "ortho" or "xp12"
+        self.head = None  # result of check_head(), may come from the tile index
+        self.new_source = False  # rebuilt tile, its backup is stale
+        self.scratch_dir = None  # directory of the intermediate files
+        self.job = None  # claimed job file of a SharedQueue
+        self.size = 0  # of the DSF when the job started
+        # state may be known from the tile index
+        if is_converted is None:
+            is_converted = os.path.isfile(self.cnv_marker)
+        if has_backup is None:
+            has_backup = os.path.isfile(self.fname_bck)
+        self.is_converted = bool(is_converted)
+        self.has_backup = bool(has_backup)
 
     def __repr__(self):
         return f"{self.fname}"
 
+    @property
+    def scratch_base(self):
+        """Base name of the intermediate files, tiles of different packs have the same name"""
+        return f"{self.dsf_base}-{hashlib.sha1(self.fname.encode()).hexdigest()[:8]}"
+
     def run_cmd(self, cmd):
         # "shell = True" is not needed on Windows, bombs on Lx
         # log.info(cmd)
-        out = subprocess.run(shlex.split(cmd), capture_output=True)
-        if out.returncode != 0:
-            log.error(f"Can't run {cmd}: {out}")
+        stage = self._records[0]["stage"] if len(self._records) > 0 else None
+        timeout = tool_timeouts.get(stage)
+        for attempt in range(1 + tool_retries):
+            returncode, out, ru, timed_out = get_proc_runner().run(shlex.split(cmd), timeout)
+            if ru is not None:
+                for rec in self._records:
+                    rec["cpu_children"] += ru.ru_utime + ru.ru_stime
+                    rec["maxrss_children"] = max(rec["maxrss_children"], maxrss(ru=ru))
+
+            if not timed_out:
+                break
+
+            log.warning(f"{self.fname}: {stage} timed out after {timeout} s, killed {cmd}")
+
+        if aborted.is_set():
+            return False
+
+        if returncode != 0:
+            log.error(f"Can't run {cmd}: returncode={returncode} {out}")
             return False
 
         return True
 
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """Measure wall time, child CPU time and peak RSS, bytes read/written of a stage"""
+        rec = {
+            "tile": self.fname,
+            "stage": stage,
+            "wall": 0.0,
+            "cpu_children": 0.0,
+            "maxrss_children": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "ok": False,
+        }
+        self._records.append(rec)
+        start = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec["wall"] = time.perf_counter() - start
+            self._records.remove(rec)
+            if run_report is not None:
+                run_report.add(rec)
+
+    def account_io(self, inputs=[], outputs=[]):
+        """Add sizes of files read and written to the running stages"""
+
+        def size(files):
+            n = 0
+            for f in files:
+                try:
+                    n += os.path.getsize(f)
+                except OSError:
+                    pass
+            return n
+
+        n_in = size(inputs)
+        n_out = size(outputs)
+        for rec in self._records:
+            rec["bytes_in"] += n_in
+            rec["bytes_out"] += n_out
+
+    # stage -> journal state
+    STAGE_STATES = {"decode": "decoding", "encode": "encoding", "compress": "compressing"}
+
+    def journal(self, state, sync=False, data=None):
+        if journal is not None:
+            journal.record(self.fname, state, sync, data)
+
+    def run_stage(self, name):
+        """Run the conversion stage = method name with timing"""
+        self.journal(self.STAGE_STATES[name])
+        with self.timed(name) as rec:
+            try:
+                rec["ok"] = getattr(self, name)()
+            finally:
+                # aborted jobs stay in their state, recovery cleans up and -resume redoes them
+                if not rec["ok"] and not aborted.is_set():
+                    self.journal("failed")
+            return rec["ok"]
+
     def convert(self):
-        i = self.fname.find("/Earth nav data/")
-        assert i > 0, "invalid filename"
+        """Run all stages of the conversion in sequence"""
+        try:
+            return (
+                self.run_stage("decode")
+                and self.run_stage("encode")
+                and self.run_stage("compress")
+            )
+        finally:
+            self.remove_tmp_files()
+
+    def place_scratch(self):
+        """Decide where the intermediate files of this job go"""
+        if scratch is not None:
+            self.scratch_dir = scratch.place(self)
+        else:
+            self.scratch_dir = work_dir
 
-        tmp_files = []
+    def remove_tmp_files(self):
+        if scratch is not None:
+            scratch.release(self)
 
+        for key in self._rc_keys:
+            raster_cache.release(key)
+        self._rc_keys = []
+
+        for f in self.tmp_files:
+            try:
+                os.remove(f)
+            except:
+                pass
+
+        self.tmp_files = []
+
+    @staticmethod
+    def raster_wanted(name):
+        return raster_re.match(name) is not None
+
+    @classmethod
+    def select_rasters(cls, lines):
+        """Return the RASTER_ lines of wanted rasters, renumbered, and the .raw files of the others"""
+        names = [l.split()[2] for l in lines if l.startswith("RASTER_DEF")]
+        data = [l for l in lines if l.startswith("RASTER_DATA")]
+        assert len(names) == len(data), "inconsistent RASTER_ lines"
+
+        defs = []
+        selected = []
+        unwanted = []
+        for name, l in zip(names, data):
+            if cls.raster_wanted(name):
+                defs.append(f"RASTER_DEF {len(defs)} {name}\n")
+                selected.append(l)
+            else:
+                # RASTER_DATA version= bpp= flags= width= height= scale= offset= filename
+                unwanted.append(l.rstrip("\r\n").split(" ", 8)[8])
+
+        return (defs + selected, unwanted)
+
+    def add_raw_files(self, dsf_txt):
+        """Register the .raw files dsf2text wrote for dsf_txt as temporary files"""
+        self.tmp_files.extend(glob.glob(glob.escape(dsf_txt) + ".*.raw"))
+
+    def find_xp12_dsf(self, quiet=False):
+        """Return the XP12 DSF for this tile or None"""
+        xp12_dsf = xp12_map.find(self.dsf_base)
+        if xp12_dsf is None:
+            if not quiet:
+                log.warning(f"{self.fname}: XP12 DSF does not exist!")
+            return None
+
+        self.xp12_dsf = xp12_dsf
+        return xp12_dsf
+
+    def preflight(self, check_atoms=True):
+        """Cheap checks whether the tile can be converted, return None or why not"""
+        if self.find_xp12_dsf(quiet=True) is None:
+            if raster_synthesize is None:
+                return "no XP12 DSF"
+            if len(self.xp12_neighbours()) == 0:
+                return "no XP12 DSF and neighbours"
+
+        if check_atoms:
+            if self.head is None:
+                head = self.check_head()
+                if head.startswith("unreadable"):
+                    return head  # may be temporary, e.g. on a network drive
+                self.head = head
+
+            if self.head != "":
+                return self.head
+
+        return None
+
+    def check_head(self):
+        """Read the head of the DSF, return "" if it can be converted or why not"""
         try:
-            o4xp_dsf_txt = os.path.join(work_dir, self.dsf_base + ".txt-o4xp")
-            tmp_files.append(o4xp_dsf_txt)
-            for n in [
-                "spr1",
-                "sum1",
-                "fal1",
-                "win1",
-                "spr2",
-                "sum2",
-                "fal2",
-                "win2",
-                "soundscape",
-                "sea_level",
-                "elevation",
-            ]:
-                tmp_files.append(
-                    f"{o4xp_dsf_txt}.{n}.raw",
-                )
+            head = DsfAtoms.read_head(self.fname)
+        except (OSError, ValueError, AssertionError, EOFError, lzma.LZMAError) as err:
+            return f"unreadable: {err}"
 
-            if not self.run_cmd(
-                f'"{dsf_tool}" -dsf2text "{self.fname}" "{o4xp_dsf_txt}"'
-            ):
-                return False
+        if not head.has_mesh():
+            return "does not contain a mesh"
 
-            # sanity checks
-            o4xp_dsf_txt_lines = open(o4xp_dsf_txt, "r").readlines()
-            if not any("PATCH_VERTEX" in l for l in o4xp_dsf_txt_lines):
-                log.warning(f"{self.fname} does not contain a mesh, skipped")
-                return False
+        if head.has_raster():
+            return "contains RASTER data"
 
-            if any("RASTER" in l for l in o4xp_dsf_txt_lines):
-                log.warning(f"{self.fname} contains RASTER data, skipped")
-                return False
+        return ""
+
+    def read_marker(self):
+        """Return the fingerprints stored in the marker, {} for markers of older versions"""
+        try:
+            with open(self.cnv_marker, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_marker(self):
+        marker = {
+            "version": VERSION,
+            "engine": engine,
+            "source": self.src_fingerprint,
+            "xp12": None if self.xp12_dsf is None else file_fingerprint(self.xp12_dsf),
+            "result": file_fingerprint(self.fname),
+        }
+        with open(self.cnv_marker, "w") as f:
+            json.dump(marker, f, indent=1)
+
+    def update_reason(self):
+        """For a converted tile return what changed since the conversion or None.
+
+        "ortho": the DSF is not the one we wrote, e.g. Ortho4XP rebuilt the tile
+        "xp12":  the XP12 DSF the rasters came from changed or moved
+        "unknown": marker of an older version without fingerprints
+        """
+        marker = self.read_marker()
+        if "result" not in marker:
+            return "unknown"
+
+        fp = file_fingerprint(self.fname)
+        if (fp["size"], fp["mtime_ns"]) != (
+            marker["result"]["size"],
+            marker["result"]["mtime_ns"],
+        ):
+            # a rebuilt tile has no rasters, a touched or copied result still has them
+            try:
+                rebuilt = not DsfAtoms.read_head(self.fname).has_raster()
+            except (OSError, ValueError, AssertionError, EOFError, lzma.LZMAError):
+                rebuilt = True  # the conversion finds out, the backup is kept until it succeeds
+            if rebuilt:
+                return "ortho"
+
+            log.info(f"{self.fname}: changed timestamp but still converted")
+
+        xp12_dsf = self.find_xp12_dsf(quiet=marker["xp12"] is None)
+        if xp12_dsf is None:
+            return None  # nothing to convert against or still resampled
+
+        if marker["xp12"] is None:
+            return "xp12"  # resampled, now the XP12 DSF exists
+
+        fp = file_fingerprint(xp12_dsf)
+        if (fp["path"], fp["size"], fp["mtime_ns"]) != (
+            marker["xp12"]["path"],
+            marker["xp12"]["size"],
+            marker["xp12"]["mtime_ns"],
+        ):
+            return "xp12"
+
+        return None
+
+    def prepare_update(self):
+        """Prepare a changed tile for conversion according to update_action"""
+        if self.update_action == "ortho":
+            # the current DSF is the new source, make_backup() replaces the stale backup
+            # once it's converted, the marker is rewritten then
+            log.info(f"{self.fname}: rebuilt since conversion, converting the new DSF")
+            self.new_source = True
+
+        elif self.update_action == "xp12":
+            # convert the original again
+            log.info(f"{self.fname}: XP12 source changed, converting the backup again")
+            tmp = self.fname + "-new-1"
+            self.restore_backup(tmp)
+            os.replace(tmp, self.fname)
+            os.remove(self.cnv_marker)
+
+        self.update_action = None
+
+    def decode(self):
+        """Stage 1: dsf2text of the ortho DSF, add RASTER data from XP12"""
+        self.prepare_update()
+        self.src_fingerprint = file_fingerprint(self.fname, with_hash=True)
+        self.place_scratch()
+        if engine == "native":
+            return self.decode_native()
+
+        self.o4xp_dsf_txt = os.path.join(self.scratch_dir, self.scratch_base + ".txt-o4xp")
+        self.tmp_files.append(self.o4xp_dsf_txt)
+        ok = self.run_cmd(
+            f'"{dsf_tool}" -dsf2text "{self.fname}" "{self.o4xp_dsf_txt}"'
+        )
+        self.add_raw_files(self.o4xp_dsf_txt)
+        if not ok:
+            return False
+
+        self.account_io([self.fname], [self.o4xp_dsf_txt])
+
+        # sanity checks
+        o4xp_scan = DsfTxtScan(self.o4xp_dsf_txt)
+        if not o4xp_scan.has_mesh:
+            log.warning(f"{self.fname} does not contain a mesh, skipped")
+            return False
+
+        if o4xp_scan.has_raster:
+            log.warning(f"{self.fname} contains RASTER data, skipped")
+            return False
+
+        # extract raster data from XP12
+        if not self.get_rasters():
+            return False
+
+        # append RASTER to o4xp file
+        with open(self.o4xp_dsf_txt, "a") as f:
+            f.writelines(self.rdata)
+
+        return True
+
+    def decode_native(self):
+        """Stage 1, native engine: read the ortho DSF's atoms, get RASTER data from XP12"""
+        self.dsf_atoms = DsfAtoms.read(self.fname)
+        self.account_io([self.fname])
+        if not self.dsf_atoms.has_mesh():
+            log.warning(f"{self.fname} does not contain a mesh, skipped")
+            return False
+
+        if self.dsf_atoms.has_raster():
+            log.warning(f"{self.fname} contains RASTER data, skipped")
+            return False
+
+        return self.get_rasters()
+
+    def encode(self):
+        """Stage 2: text2dsf of the augmented text file"""
+        self.fname_new = self.fname + "-new"
+        self.fname_new_1 = os.path.join(self.scratch_dir, self.scratch_base + ".dsf-new")
+        self.tmp_files.append(self.fname_new_1)
+        if engine == "native":
+            self.encode_native()
+            self.account_io([], [self.fname_new_1])
+            return True
+
+        if not self.run_cmd(
+            f'"{dsf_tool}" -text2dsf "{self.o4xp_dsf_txt}" "{self.fname_new_1}"'
+        ):
+            return False
+
+        self.account_io([self.o4xp_dsf_txt], [self.fname_new_1])
+        return True
 
-            # extract raster data from XP12
-            # demo areas overlay global scenery
-            xp12_dsf = (
-                xp12_root + "/Global Scenery/X-Plane 12 Demo Areas" + self.fname[i:]
+    def encode_native(self):
+        """Stage 2, native engine: splice the XP12 rasters into the ortho DSF's atoms"""
+        names = [l.split()[2] for l in self.rdata if l.startswith("RASTER_DEF")]
+        data = [l for l in self.rdata if l.startswith("RASTER_DATA")]
+        assert len(names) == len(data), "inconsistent RASTER_ lines"
+
+        rasters = []
+        for name, l in zip(names, data):
+            # RASTER_DATA version= bpp= flags= width= height= scale= offset= filename
+            words = l.rstrip("\r\n").split(" ", 8)
+            v = dict(w.split("=") for w in words[1:8])
+            demi = struct.pack(
+                "<BBHIIff",
+                int(v["version"]),
+                int(v["bpp"]),
+                int(v["flags"]),
+                int(v["width"]),
+                int(v["height"]),
+                float(v["scale"]),
+                float(v["offset"]),
             )
-            if not os.path.isfile(xp12_dsf):
-                xp12_dsf = (
-                    xp12_root
-                    + "/Global Scenery/X-Plane 12 Global Scenery"
-                    + self.fname[i:]
-                )
+            with open(words[8], "rb") as f:
+                rasters.append((name, demi, f.read()))
+            self.account_io([words[8]])
+
+        self.dsf_atoms.set_rasters(rasters)
+        self.dsf_atoms.write(self.fname_new_1)
+        self.dsf_atoms = None
+
+    def compress(self):
+        """Stage 3: 7zip the new DSF and swap it in"""
+        if cmd_7zip is None:
+            write_7z(self.fname_new_1, self.fname_new, os.path.basename(self.fname))
+        elif not self.run_cmd(
+            f'"{cmd_7zip}" a -t7z -m0=lzma "{self.fname_new}" "{self.fname_new_1}"'
+        ):
+            return False
 
-            xp12_dsf = os.path.normpath(xp12_dsf)
-            if not os.path.isfile(xp12_dsf):
-                log.warning(f"{xp12_dsf} does not exist!")
-                return False
+        self.account_io([self.fname_new_1], [self.fname_new])
+        self.remove_tmp_files()
+
+        # the new DSF must be on disk before the swap is journaled
+        with open(self.fname_new, "rb+") as f:
+            os.fsync(f.fileno())
+        self.make_backup()
+        self.journal(
+            "swapping", sync=True, data={"source": self.src_fingerprint, "xp12": self.xp12_dsf}
+        )
+        os.replace(self.fname_new, self.fname)  # atomic, the DSF never goes missing
+        self.journal("swapped", sync=True)
+        self.write_marker()
+        self.journal("done")
+        return True
+
+    def recover(self, state, data):
+        """Clean up after a crash of a conversion in state, return True if it completed.
 
-            xp12_dsf_txt = os.path.join(work_dir, self.dsf_base + ".txt-xp12")
-            tmp_files.append(xp12_dsf_txt)
-            for n in [
-                "spr1",
-                "sum1",
-                "fal1",
-                "win1",
-                "spr2",
-                "sum2",
-                "fal2",
-                "win2",
-                "soundscape",
-                "sea_level",
-                "elevation",
-            ]:
-                tmp_files.append(
-                    f"{xp12_dsf_txt}.{n}.raw",
+        data is what was journaled with the state, for "swapping" the source
+        fingerprint and the XP12 DSF needed for the marker.
+        """
+        fname_new = self.fname + "-new"
+        if state == "swapping" or state == "swapped":
+            # the new DSF was complete when the swap started
+            if os.path.isfile(fname_new):
+                os.replace(fname_new, self.fname)
+            self.src_fingerprint = data.get("source")
+            if "xp12" in data:
+                self.xp12_dsf = data["xp12"]
+            else:
+                self.find_xp12_dsf(quiet=True)  # journal of an older version
+            try:
+                self.write_marker()
+            except OSError:
+                open(self.cnv_marker, "w")  # 'update' converts it again
+            log.info(f"journal: completed conversion of {self.fname}")
+            return True
+
+        orphans = [fname_new, fname_new + "-1", self.fname_bck + "-new"]
+        for dir in [work_dir] + ([scratch.ram_dir] if scratch is not None else []):
+            for pattern in [".txt-*", ".dsf-new"]:
+                orphans.extend(
+                    glob.glob(os.path.join(glob.escape(dir), glob.escape(self.scratch_base) + pattern))
                 )
 
-            # print(xp12_dsf)
-            # print(xp12_dsf_txt)
-            if not self.run_cmd(
-                f'"{dsf_tool}" -dsf2text "{xp12_dsf}" "{xp12_dsf_txt}"'
-            ):
-                return False
+        for f in orphans:
+            if os.path.isfile(f):
+                os.remove(f)
+                log.info(f"journal: removed orphaned {f}")
 
-            with open(xp12_dsf_txt, "r") as dsft:
-                for l in dsft.readlines():
-                    if l.find("RASTER_") == 0:
-                        self.rdata.append(l)
-
-            # append RASTER to o4xp file
-            with open(o4xp_dsf_txt, "a") as f:
-                for l in self.rdata:
-                    if (
-                        l.find("spr") > 0
-                        or l.find("sum") > 0
-                        or l.find("win") > 0  # use a positive list
-                        or l.find("fal") > 0
-                        or l.find("soundscape") > 0
-                        or l.find("elevation") > 0
-                    ):
-                        f.write(l)
-
-            # always create a backup
-            if not os.path.isfile(self.fname_bck):
-                shutil.copy2(self.fname, self.fname_bck)
-
-            fname_new = self.fname + "-new"
-            fname_new_1 = fname_new + "-1"
-            tmp_files.append(fname_new_1)
-            if not self.run_cmd(
-                f'"{dsf_tool}" -text2dsf "{o4xp_dsf_txt}" "{fname_new_1}"'
-            ):
-                return False
+        return False
 
-            if not self.run_cmd(
-                f'"{cmd_7zip}" a -t7z -m0=lzma "{fname_new}" "{fname_new_1}"'
-            ):
-                return False
-        finally:
-            for f in tmp_files:
-                try:
-                    os.remove(f)
-                except:
-                    pass
+    def get_xp12_rasters(self, xp12_dsf):
+        """Get RASTER_ lines of xp12_dsf into self.rdata, from the cache if possible"""
+        with self.timed("xp12_rasters") as rec:
+            rec["ok"] = self._get_xp12_rasters(xp12_dsf)
+            return rec["ok"]
+
+    def _get_xp12_rasters(self, xp12_dsf):
+        lines = self.xp12_raster_lines(
+            xp12_dsf, os.path.join(self.scratch_dir, self.scratch_base + ".txt-xp12")
+        )
+        if lines is None:
+            return False
 
-        os.remove(self.fname)
-        os.rename(fname_new, self.fname)
-        open(self.cnv_marker, "w")  # create the marker
+        self.rdata.extend(lines)
         return True
 
+    def xp12_raster_lines(self, xp12_dsf, xp12_dsf_txt):
+        """Return the wanted RASTER_ lines of xp12_dsf, from the cache if possible, None on error"""
+        if raster_cache is not None:
+            key = raster_cache.key(xp12_dsf, raster_include)
+            lines = raster_cache.lookup(key)
+            if lines is not None:
+                self._rc_keys.append(key)
+                return lines
+
+        self.tmp_files.append(xp12_dsf_txt)
+
+        # print(xp12_dsf)
+        # print(xp12_dsf_txt)
+        if engine == "native":
+            lines = self.extract_rasters_native(xp12_dsf, xp12_dsf_txt)
+            self.add_raw_files(xp12_dsf_txt)
+        else:
+            ok = self.run_cmd(f'"{dsf_tool}" -dsf2text "{xp12_dsf}" "{xp12_dsf_txt}"')
+            self.add_raw_files(xp12_dsf_txt)
+            if not ok:
+                return None
+
+            lines, unwanted = self.select_rasters(
+                DsfTxtScan(xp12_dsf_txt, rasters_only=True).rasters
+            )
+            for f in unwanted:
+                os.remove(f)
+
+        self.account_io(
+            [xp12_dsf],
+            [xp12_dsf_txt]
+            + [l.rstrip("\r\n").split(" ", 8)[8] for l in lines if l.startswith("RASTER_DATA")],
+        )
+
+        if raster_cache is not None:
+            lines = raster_cache.store(key, lines, xp12_dsf_txt)
+            self._rc_keys.append(key)
+
+        return lines
+
+    # neighbours of a tile, edges first
+    NEIGHBOURS = [(0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+    def lat_lon(self):
+        """(lat, lon) of the tile's SW corner or None"""
+        m = re.match(r"([+-]\d\d)([+-]\d\d\d)$", self.dsf_base)
+        return None if m is None else (int(m.group(1)), int(m.group(2)))
+
+    def xp12_neighbours(self):
+        """Return {(dlat, dlon): XP12 DSF} of the neighbours of the tile"""
+        ll = self.lat_lon()
+        if ll is None:
+            return {}
+
+        neighbours = {}
+        for dlat, dlon in self.NEIGHBOURS:
+            lat = ll[0] + dlat
+            lon = (ll[1] + dlon + 180) % 360 - 180
+            if lat < -90 or lat > 89:
+                continue
+
+            xp12_dsf = xp12_map.find(f"{lat:+03d}{lon:+04d}")
+            if xp12_dsf is not None:
+                neighbours[(dlat, dlon)] = xp12_dsf
+
+        return neighbours
+
+    def get_rasters(self):
+        """Get the RASTER_ lines of the tile into self.rdata"""
+        xp12_dsf = self.find_xp12_dsf(quiet=raster_synthesize is not None)
+        if xp12_dsf is not None:
+            return self.get_xp12_rasters(xp12_dsf)
+
+        return raster_synthesize is not None and self.synthesize_rasters()
+
+    def synthesize_rasters(self):
+        """Resample the rasters of the neighbouring XP12 tiles for a tile without XP12 DSF"""
+        with self.timed("synthesize") as rec:
+            neighbours = self.xp12_neighbours()
+            if len(neighbours) == 0:
+                log.warning(f"{self.fname}: neither XP12 DSF nor neighbours exist!")
+                return False
+
+            log.info(f"{self.fname}: no XP12 DSF, resampling {len(neighbours)} neighbours")
+            import raster_tool
+
+            sources = {}
+            for (dlat, dlon), xp12_dsf in neighbours.items():
+                txt = os.path.join(self.scratch_dir, f"{self.scratch_base}.txt-xp12{dlat:+d}{dlon:+d}")
+                lines = self.xp12_raster_lines(xp12_dsf, txt)
+                if lines is None:
+                    return False
+                sources[(dlat, dlon)] = raster_tool.rasters_of_lines(lines)
+
+            prefix = os.path.join(self.scratch_dir, self.scratch_base + ".txt-synth")
+            lines = raster_tool.synthesize(
+                self.lat_lon()[0], sources, raster_synthesize == "bilinear", prefix
+            )
+            self.add_raw_files(prefix)
+            self.rdata.extend(lines)
+            rec["ok"] = True
+            return True
+
+    @staticmethod
+    def extract_rasters_native(xp12_dsf, xp12_dsf_txt):
+        """Write the wanted rasters of xp12_dsf to .raw files as dsf2text does, return RASTER_ lines"""
+        rasters = DsfAtoms.read(xp12_dsf).rasters()
+        defs = []
+        data = []
+        for name, demi, demd in rasters:
+            if not Dsf.raster_wanted(name):
+                continue
+
+            version, bpp, flags, width, height, scale, offset = struct.unpack(
+                "<BBHIIff", demi[:20]
+            )
+            raw = f"{xp12_dsf_txt}.{name}.raw"
+            with open(raw, "wb") as f:
+                f.write(demd)
+
+            defs.append(f"RASTER_DEF {len(defs)} {name}\n")
+            data.append(
+                f"RASTER_DATA version={version} bpp={bpp} flags={flags} width={width}"
+                f" height={height} scale={scale:.9g} offset={offset:.9g} {raw}\n"
+            )
+
+        return defs + data
+
+    def make_backup(self):
+        """Always create a backup, the swap then leaves the original to it"""
+        bck = self.fname_bck
+        if os.path.isfile(bck):
+            if not self.new_source:
+                return
+            bck = self.fname_bck + "-new"  # the stale one is replaced below
+
+        if backup_store is not None:
+            backup_store.put(self.fname, self.src_fingerprint["sha1"], bck)
+        elif clone_file(self.fname, bck, backup_link) == "copy":
+            self.account_io([self.fname], [bck])
+
+        if bck != self.fname_bck:
+            os.replace(bck, self.fname_bck)
+
+    def backup_shared(self):
+        """True if the backup has other links, e.g. to an object of the backup store"""
+        return os.stat(self.fname_bck).st_nlink > 1
+
+    def restore_backup(self, dst):
+        """Write the original DSF to dst"""
+        if BackupStore.is_compressed(self.fname_bck):
+            BackupStore.decompress(self.fname_bck, dst)
+        else:
+            # a live DSF must not share its inode with the store
+            clone_file(self.fname_bck, dst, backup_link and not self.backup_shared())
+
     def undo(self):
-        os.remove(self.fname)
-        os.rename(self.fname_bck, self.fname)
+        # without the marker an interrupted undo is simply repeated
         try:
             os.remove(self.cnv_marker)
         except:
             pass
 
+        if BackupStore.is_compressed(self.fname_bck) or self.backup_shared():
+            # the backup is an object of the store, the DSF gets its own copy
+            tmp = self.fname + "-undo"
+            self.restore_backup(tmp)
+            os.replace(tmp, self.fname)
+            os.remove(self.fname_bck)
+        else:
+            os.replace(self.fname_bck, self.fname)  # atomic, the DSF never goes missing
+
     def cleanup(self):
         os.remove(self.fname_bck)
 
@@ -203,15 +2388,193 @@ class DsfList:
     M_REDO = 1
     M_UNDO = 2
     M_CLEANUP = 3
+    M_UPDATE = 4
+
+    @staticmethod
+    def is_convert(mode):
+        return mode in [DsfList.M_CONVERT, DsfList.M_REDO, DsfList.M_UPDATE]
+
+    # conversion pipeline, stage name = Dsf method
+    STAGES = ["decode", "encode", "compress"]
+
+    # scheduling policies = order of the queue
+    SCHEDULES = ["fifo", "largest", "proximity"]
 
     def __init__(self, dir_re, xp12_root, ortho_dir):
         self._dir_re = re.compile(dir_re)
-        self.queue = Queue()
+        self.schedule = "fifo"
+        self.near = None  # (lat, lon) for schedule proximity
+        self.queue = DsfQueue(self.priority)
         self._threads = []
+        self._lock = threading.Lock()
+        self._stage_active = []
+        self.admission = None
+        self.tile_index = None
+        self.shared_queue = None
+        self.full_rescan = False
+        self.preflight = True
+        self.n_skipped = 0
+        self.xp12_gaps = []  # tiles without XP12 DSF
+        self._done = Queue()  # completed jobs (dsf, ok), None when a thread exits
+        self._stop = threading.Event()  # don't start new jobs
+        self._n_started = 0
         self.xp12_root = xp12_root
         self.ortho_dir = os.path.normpath(ortho_dir)
 
+    def priority(self, dsf):
+        """Sort key of dsf in the queue, lowest first"""
+        if self.schedule == "largest":
+            # longest processing time first, size is a good estimate of the cost
+            try:
+                return -os.path.getsize(dsf.fname)
+            except OSError:
+                return 0
+
+        if self.schedule == "proximity":
+            m = re.match(r"([+-]\d\d)([+-]\d\d\d)", dsf.dsf_base)
+            if m is None:
+                return math.inf
+
+            # great circle distance to the tile's center in km
+            lat1, lon1 = [math.radians(x) for x in self.near]
+            lat2 = math.radians(int(m.group(1)) + 0.5)
+            lon2 = math.radians(int(m.group(2)) + 0.5)
+            a = (
+                math.sin((lat2 - lat1) / 2) ** 2
+                + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+            )
+            return 2 * 6371 * math.asin(min(1.0, math.sqrt(a)))
+
+        return 0
+
+    def put(self, dsf, mode):
+        self.queue.put(dsf)
+        if self.is_convert(mode):
+            log.info(f"queued {dsf}")
+            dsf.journal("queued")
+        else:
+            log.debug(f"queued {dsf}")
+
+    def passes_preflight(self, dsf, check_atoms):
+        if not self.preflight:
+            return True
+
+        reason = dsf.preflight(check_atoms)
+        if reason is None:
+            return True
+
+        log.info(f"{dsf}: {reason}, skipped")
+        self.n_skipped += 1
+        if reason.startswith("no XP12 DSF"):
+            self.xp12_gaps.append(dsf.dsf_base)
+        return False
+
+    def queue_dsf(self, dsf, mode):
+        """Queue dsf if it qualifies for mode, return True if queued"""
+        if mode == self.M_CONVERT and not dsf.is_converted:
+            if self.passes_preflight(dsf, True):
+                self.put(dsf, mode)
+                return True
+
+        elif mode == self.M_REDO and dsf.is_converted:
+            if dsf.has_backup:
+                # the backup is converted, the live DSF has rasters, only the XP12 DSF is checked
+                if self.passes_preflight(dsf, False):
+                    self.put(dsf, mode)
+                    return True
+            else:
+                log.warning(f"{dsf} has no backup")
+
+        elif mode == self.M_UNDO:
+            if dsf.has_backup:
+                self.put(dsf, mode)
+                return True
+            elif dsf.is_converted:
+                log.warning(f"{dsf} has no backup, can't undo")
+
+        elif mode == self.M_CLEANUP:
+            if dsf.has_backup and dsf.is_converted:
+                self.put(dsf, mode)
+                return True
+
+        elif mode == self.M_UPDATE:
+            reason = dsf.update_reason() if dsf.is_converted else "new"
+            if reason == "unknown":
+                log.info(f"{dsf} was converted by an older version, use redo if needed")
+            elif reason == "xp12" and not dsf.has_backup:
+                log.warning(f"{dsf} XP12 source changed but it has no backup")
+            elif reason is not None and self.passes_preflight(dsf, reason != "xp12"):
+                dsf.update_action = reason
+                log.info(f"{dsf}: update, {reason}")
+                self.put(dsf, mode)
+                return True
+
+        return False
+
+    def publish(self):
+        """Move all queued jobs to the shared queue"""
+        n = 0
+        while True:
+            try:
+                dsf = self.queue.get(block=False)
+            except Empty:
+                break
+
+            self.shared_queue.publish(dsf)
+            n += 1
+
+        log.info(f"Published {n} jobs to {self.shared_queue.queue_dir}")
+
+    def next_job(self, q):
+        """Return the next job from q, raise Empty if there is none or we are stopping"""
+        if self._stop.is_set():
+            raise Empty
+
+        dsf = q.get(block=False)
+        try:
+            dsf.size = os.path.getsize(dsf.fname)
+        except OSError:
+            pass
+
+        with self._lock:
+            self._n_started += 1
+        return dsf
+
+    def finish(self, dsf, ok):
+        """Report the end of the job dsf"""
+        if dsf.job is not None and not aborted.is_set():  # else the claim goes stale and is requeued
+            self.shared_queue.complete(dsf, ok)
+
+        self._done.put((dsf, ok))
+
+    def _thread(self, target, *args):
+        try:
+            target(*args)
+        finally:
+            self._done.put(None)
+
+    def start_thread(self, target, *args):
+        t = threading.Thread(target=self._thread, args=(target,) + args, daemon=True)
+        self._threads.append(t)
+        t.start()
+
+    def scan_journal(self, mode, limit):
+        """Queue the tiles left unfinished by previous runs"""
+        for tile in journal.unfinished:
+            if limit <= 0:
+                break
+
+            if os.path.isfile(tile):
+                self.put(Dsf(tile), mode)
+                limit = limit - 1
+
+        log.info(f"Queued {self.queue.qsize()} files")
+
     def scan(self, mode, limit, subset, rect):
+        if self.tile_index is not None:
+            self.scan_index(mode, limit, subset, rect)
+            return
+
         lat_lon_re = None
         if rect is not None:
             lat1, lon1, lat2, lon2 = rect
@@ -243,301 +2606,737 @@ class DsfList:
                         if lat < lat1 or lon < lon1 or lat > lat2 or lon > lon2:
                             continue
 
-                    dsf = Dsf(full_name)
-                    if mode == self.M_CONVERT and not dsf.is_converted:
-                        self.queue.put(dsf)
+                    if self.queue_dsf(Dsf(full_name), mode):
                         limit = limit - 1
-                        log.info(f"queued {dsf}")
-
-                    elif mode == self.M_REDO and dsf.is_converted:
-                        if dsf.has_backup:
-                            self.queue.put(dsf)
-                            log.info(f"queued {dsf}")
-                            limit = limit - 1
-                        else:
-                            log.warning(f"{dsf} has no backup")
-
-                    elif mode == self.M_UNDO:
-                        if dsf.has_backup:
-                            self.queue.put(dsf)
-                            log.info(f"queued {dsf}")
-                            limit = limit - 1
-                        elif dsf.is_converted:
-                            log.warning(f"{dsf} has no backup, can't undo")
-
-                    elif mode == self.M_CLEANUP:
-                        if dsf.has_backup and dsf.is_converted:
-                            self.queue.put(dsf)
-                            limit = limit - 1
-                            log.info(f"queued {dsf}")
         except StopIteration:
             pass
 
-        log.info(f"Queued {self.queue.qsize()} files")
+        self.log_queued()
+        if self.is_convert(mode):
+            self.log_coverage()
+
+    def log_queued(self):
+        msg = f"Queued {self.queue.qsize()} files"
+        if self.n_skipped > 0:
+            msg += f", {self.n_skipped} can't be converted"
+        log.info(msg)
+
+    def log_coverage(self):
+        """Report the tiles that have no XP12 DSF before the conversion starts"""
+        queued = [
+            dsf.dsf_base for _, _, dsf in self.queue.queue if xp12_map.find(dsf.dsf_base) is None
+        ]
+        gaps = sorted(set(self.xp12_gaps + queued))
+        if len(gaps) == 0:
+            return
+
+        msg = f"XP12 coverage: {len(gaps)} tiles without XP12 DSF: {', '.join(gaps[:20])}"
+        if len(gaps) > 20:
+            msg += ", ..."
+        if len(queued) > 0:
+            if raster_synthesize is not None:
+                msg += f"; {len(queued)} are resampled from neighbours"
+            else:
+                msg += f"; {len(queued)} are queued and will fail, enable synthesize or preflight"
+        log.warning(msg)
+
+    def scan_index(self, mode, limit, subset, rect):
+        self.tile_index.refresh(self.ortho_dir, self.full_rescan)
+        heads = []  # new results of head checks for the index
+        for path, is_converted, has_backup, head in self.tile_index.select(
+            self.ortho_dir, self._dir_re.pattern, subset, rect
+        ):
+            if limit <= 0:
+                break
+
+            dsf = Dsf(path, is_converted, has_backup)
+            dsf.head = head
+            if self.queue_dsf(dsf, mode):
+                limit = limit - 1
+            if dsf.head != head:
+                heads.append((dsf.head, path))
+
+        self.tile_index.set_heads(heads)
+        self.log_queued()
+        if self.is_convert(mode):
+            self.log_coverage()
 
     def worker(self, i, mode):
         while True:
             try:
-                dsf = self.queue.get(
-                    block=False, timeout=5
-                )  # timeout to make it interruptible
+                dsf = self.next_job(self.queue)
             except Empty:
                 break
 
+            is_convert = self.is_convert(mode)
+            if is_convert and self.admission is not None:
+                self.admission.acquire(dsf)
+
             log.info(f"Worker {i} --> {dsf}")
 
+            ok = False
             try:
-                if mode == DsfList.M_CONVERT or mode == DsfList.M_REDO:
-                    dsf.convert()
+                if is_convert:
+                    ok = dsf.convert()
                 elif mode == DsfList.M_UNDO:
                     dsf.undo()
+                    ok = True
                 elif mode == DsfList.M_CLEANUP:
                     dsf.cleanup()
+                    ok = True
                 else:
                     assert False
 
             except Exception as err:
                 log.warning({err})
 
+            if is_convert and self.admission is not None:
+                self.admission.release(dsf)
+
+            self.finish(dsf, ok)
+
             log.info(f"Worker {i} <-- {dsf}")
 
-    def execute(self, num_workers, mode):
-        qlen_start = self.queue.qsize()
-        start_time = time.time()
+    def stage_worker(self, stage, i, q_in, q_out, n_out):
+        """Run Dsf method STAGES[stage] on jobs from q_in and pass them on to q_out"""
+        name = self.STAGES[stage]
+        try:
+            while True:
+                if stage == 0:
+                    try:
+                        dsf = self.next_job(q_in)
+                    except Empty:
+                        break
+                else:
+                    dsf = q_in.get()  # blocks until upstream delivers
+                    if dsf is None:
+                        break
+
+                if stage == 0:
+                    self._in_flight.acquire()
+                    if self.admission is not None:
+                        self.admission.acquire(dsf)
 
-        for i in range(num_workers):
-            t = threading.Thread(target=self.worker, args=(i, mode), daemon=True)
-            self._threads.append(t)
-            t.start()
+                log.info(f"{name} {i} --> {dsf}")
 
+                ok = False
+                try:
+                    ok = dsf.run_stage(name)
+                except Exception as err:
+                    log.warning(f"{dsf}: {err}")
+
+                if ok and q_out is not None:
+                    q_out.put(dsf)  # blocks if downstream is busy
+                else:
+                    dsf.remove_tmp_files()
+                    if self.admission is not None:
+                        self.admission.release(dsf)
+                    self._in_flight.release()
+                    self.finish(dsf, ok)
+
+                log.info(f"{name} {i} <-- {dsf}")
+        finally:
+            # the last worker of a stage tells the next stage to terminate, also if this one died
+            with self._lock:
+                self._stage_active[stage] -= 1
+                last = self._stage_active[stage] == 0
+
+            if last and q_out is not None:
+                for _ in range(n_out):
+                    q_out.put(None)
+
+    def start_pipeline(self, stage_workers, num_workers):
+        """Start stage_workers[k] threads for STAGES[k] connected by bounded queues.
+
+        At most num_workers tiles are in the pipeline at any time.
+        """
+        self._stage_active = list(stage_workers)
+        self._in_flight = threading.BoundedSemaphore(num_workers)
+        q_in = self.queue
+        for stage, n in enumerate(stage_workers):
+            if stage + 1 < len(stage_workers):
+                n_out = stage_workers[stage + 1]
+                q_out = Queue(maxsize=n_out)
+            else:
+                n_out = 0
+                q_out = None
+
+            for i in range(n):
+                self.start_thread(self.stage_worker, stage, i, q_in, q_out, n_out)
+
+            q_in = q_out
+
+    # tiles per batch of bulk()
+    BULK_BATCH = 500
+
+    def bulk(self, num_workers, mode):
+        """Undo or cleanup the queued tiles in batches.
+
+        These are only renames and unlinks, a batch is done by one thread
+        without the per tile overhead of execute().
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        op = Dsf.undo if mode == self.M_UNDO else Dsf.cleanup
+
+        def run(batch):
+            failed = 0
+            for dsf in batch:
+                try:
+                    op(dsf)
+                except Exception as err:  # e.g. a corrupt compressed backup
+                    log.warning(f"{dsf}: {err}")
+                    failed += 1
+            return failed
+
+        batches = []
         while True:
-            qlen = self.queue.qsize()
-            if qlen == 0:
+            batch = []
+            try:
+                while len(batch) < self.BULK_BATCH:
+                    batch.append(self.queue.get(block=False))
+            except Empty:
+                pass
+
+            if len(batch) == 0:
                 break
-            log.info(
-                f"{qlen_start - qlen}/{qlen_start} = {100 * (1-qlen/qlen_start):0.1f}% processed"
-            )
-            time.sleep(20)
+            batches.append(batch)
+
+        start_time = time.time()
+        total = sum(len(b) for b in batches)
+        completed = failed = 0
+        with ThreadPoolExecutor(max_workers=num_workers) as ex:
+            for batch, n_failed in zip(batches, ex.map(run, batches)):
+                completed += len(batch)
+                failed += n_failed
+                log.info(f"{completed}/{total} = {100 * completed / total:0.1f}% processed, {failed} failed")
+
+        log.info(f"Processed {completed} tiles in {time.time() - start_time:0.1f} seconds")
+
+    def progress(self, completed, failed, nbytes, elapsed):
+        """Log completed tiles, throughput and ETA"""
+        with self._lock:
+            running = self._n_started - completed
+        total = completed + running + self.queue.qsize()
+        rate = completed / elapsed if elapsed > 0 else 0.0
+        msg = (
+            f"{completed}/{total} = {100 * completed / max(total, 1):0.1f}% processed"
+            f", {failed} failed, {60 * rate:0.1f} tiles/min"
+            f", {nbytes / (1024 * 1024) / max(elapsed, 1e-3):0.1f} MB/s"
+        )
+        if rate > 0 and total > completed:
+            eta = int((total - completed) / rate)
+            msg += f", ETA {eta // 3600}:{eta % 3600 // 60:02d}:{eta % 60:02d}"
+        log.info(msg)
+
+    def execute(self, num_workers, mode, stage_workers=None):
+        start_time = time.time()
+
+        if stage_workers is not None and self.is_convert(mode):
+            self.start_pipeline(stage_workers, num_workers)
+        else:
+            for i in range(num_workers):
+                self.start_thread(self.worker, i, mode)
+
+        # wait for completions until all threads have exited
+        n_threads = len(self._threads)
+        completed = failed = nbytes = 0
+        while n_threads > 0:
+            try:
+                # the timeout keeps Ctrl-C working on Windows
+                item = self._done.get(timeout=1)
+            except Empty:
+                continue
+            except KeyboardInterrupt:
+                if self._stop.is_set():  # second Ctrl-C
+                    aborted.set()
+                    if proc_runner is not None:
+                        proc_runner.kill_all()
+                    raise
+
+                self._stop.set()
+                log.warning("Interrupted, finishing running jobs. Ctrl-C again to abort.")
+                continue
+
+            if item is None:
+                n_threads -= 1
+                continue
+
+            dsf, ok = item
+            completed += 1
+            if not ok:
+                failed += 1
+            nbytes += dsf.size
+            self.progress(completed, failed, nbytes, time.time() - start_time)
 
         for t in self._threads:
             t.join()
 
         end_time = time.time()
         log.info(
-            f"Processed {qlen_start} tiles in {end_time - start_time:0.1f} seconds"
+            f"Processed {completed} tiles in {end_time - start_time:0.1f} seconds"
         )
+        if self._stop.is_set():
+            msg = f"Interrupted, {self.queue.qsize()} tiles not processed"
+            if journal is not None:
+                msg += ", continue with -resume"
+            log.warning(msg)
+        if run_report is not None:
+            run_report.summary()
 
 
 ###########
 ## main
 ###########
-logging.basicConfig(
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler(filename="o4x_2_xp12.log", mode="w"),
-        logging.StreamHandler(),
-    ],
-)
-
-log.info(f"Version: {VERSION}")
-log.info(f"args: {sys.argv}")
-isRunningInXplaneRoot = False
-CURRENT_DIR = os.getcwd()
-
-CFG = configparser.ConfigParser()
-if not os.path.isfile("o4xp_2_xp12.ini"):
-    #  log current directory
-    log.info(f"Current directory: {CURRENT_DIR}")
-    if os.path.isfile(
-        os.path.join(
-            CURRENT_DIR,
-            "Resources/default scenery/airport scenery/library.txt",
-        )
-    ):
-        log.warning("You are in an X-Plane root directory, but the ini file is missing")
-        # make some default settings
-        CFG["DEFAULTS"] = {
-            "xp12_root": CURRENT_DIR,
-            "ortho_dir": CURRENT_DIR + "/Custom Scenery",
-            "work_dir": tempfile.gettempdir(),
-            "num_workers": "10",
-        }
-        CFG["TOOLS"] = {}
-        # let's save the ini file
-        with open("o4xp_2_xp12.ini", "w") as configfile:
-            CFG.write(configfile)
-        log.info("Default ini file 'o4xp_2_xp12.ini' created in current directory")
-        isRunningInXplaneRoot = True
-    else:
-        log.error("ini file 'o4xp_2_xp12.ini' does not exist or not in X-Plane root")
-        sys.exit(1)
-
-CFG.read("o4xp_2_xp12.ini")
-dry_run = False
-
-
 def usage():
     log.error(
-        """o4xp_2_xp12 [-rect lower_left,upper_right] [-subset string] [-limit n] [-dry_run] [-root xp12_root] convert|undo|cleanup
+        """o4xp_2_xp12 [-rect lower_left,upper_right] [-subset string] [-limit n] [-dry_run] [-rescan] [-resume] [-near ICAO|lat,lon] [-coordinator|-worker] [-root xp12_root] convert|update|undo|cleanup
             -rect       restrict to rectangle, corners format is lat,lon, e.g. +50+009
             -subset     matching filenames must contain the string
             -dry_run    only list matching files
+            -rescan     rescan all directories, don't trust the tile index
+            -resume     only convert tiles left unfinished by previous runs
+            -near       convert tiles closest to this airport or position first
+            -coordinator  scan and publish the jobs to the shared queue_dir, don't process them
+            -worker       process jobs from the shared queue_dir instead of scanning
             -root       override root
             -limit n    limit operation to n dsf files
 
             convert     you guessed it
+            update      convert new tiles and tiles whose ortho or XP12 DSF changed since conversion
             undo        undo conversions
             cleanup     remove backup files
 
-            convert, undo, cleanup are mutually exclusive
+            convert, update, undo, cleanup are mutually exclusive
 
             Examples:
                 o4xp_2_xp12 -rect +36+019,+40+025 convert
                 o4xp_2_xp12 -subset z_ao_eur -dry_run cleanup
                 o4xp_2_xp12 -root E:/XP12-test -subset z_ao_eur -limit 1000 convert
+                o4xp_2_xp12 -near EDDF convert
+                o4xp_2_xp12 -coordinator convert      (on one host, then on every host:)
+                o4xp_2_xp12 -worker convert
                 o4xp_2_xp12 -rect +36+019,+40+025 -cleanup
         """
     )
     sys.exit(2)
 
 
-mode = None
-subset = None
-rect = None
+def main():
+    global xp12_root, work_dir, dsf_tool, engine, cmd_7zip, raster_include, raster_re
+    global raster_cache, run_report, journal, scratch, xp12_map, backup_link, backup_store
+    global tool_retries, raster_synthesize
 
-limit = 10000000
+    logging.basicConfig(
+        level=logging.INFO,
+        handlers=[
+            logging.FileHandler(filename="o4x_2_xp12.log", mode="w"),
+            logging.StreamHandler(),
+        ],
+    )
 
-i = 1
-while i < len(sys.argv):
-    if sys.argv[i] == "-root":
-        i = i + 1
-        if i >= len(sys.argv):
+    log.info(f"Version: {VERSION}")
+    log.info(f"args: {sys.argv}")
+    CURRENT_DIR = os.getcwd()
+
+    CFG = configparser.ConfigParser()
+    if not os.path.isfile("o4xp_2_xp12.ini"):
+        #  log current directory
+        log.info(f"Current directory: {CURRENT_DIR}")
+        if os.path.isfile(
+            os.path.join(
+                CURRENT_DIR,
+                "Resources/default scenery/airport scenery/library.txt",
+            )
+        ):
+            log.warning("You are in an X-Plane root directory, but the ini file is missing")
+            # make some default settings
+            import tempfile
+
+            CFG["DEFAULTS"] = {
+                "xp12_root": CURRENT_DIR,
+                "ortho_dir": CURRENT_DIR + "/Custom Scenery",
+                "work_dir": tempfile.gettempdir(),
+                "num_workers": "10",
+            }
+            CFG["TOOLS"] = {}
+            # let's save the ini file
+            with open("o4xp_2_xp12.ini", "w") as configfile:
+                CFG.write(configfile)
+            log.info("Default ini file 'o4xp_2_xp12.ini' created in current directory")
+        else:
+            log.error("ini file 'o4xp_2_xp12.ini' does not exist or not in X-Plane root")
+            sys.exit(1)
+
+    CFG.read("o4xp_2_xp12.ini")
+    dry_run = False
+    full_rescan = False
+    resume = False
+    near = None
+    coordinator = False
+    worker = False
+
+    mode = None
+    subset = None
+    rect = None
+
+    limit = 10000000
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == "-root":
+            i = i + 1
+            if i >= len(sys.argv):
+                usage()
+
+            xp12_root = sys.argv[i]
+            CFG["DEFAULTS"][
+                "xp12_root"
+            ] = xp12_root  # other values may be interpolated on xp12_root
+
+        elif sys.argv[i] == "-rect":
+            i = i + 1
+            if i >= len(sys.argv):
+                usage()
+
+            m = re.match(r"([+-]\d\d)([+-]\d\d\d),([+-]\d\d)([+-]\d\d\d)", sys.argv[i])
+            if m is None:
+                usage()
+
+            lat1 = int(m.group(1))
+            lon1 = int(m.group(2))
+            lat2 = int(m.group(3))
+            lon2 = int(m.group(4))
+            log.info(f"restricting to rect ({lat1},{lon1}) -> ({lat2},{lon2})")
+            rect = (lat1, lon1, lat2, lon2)
+
+        elif sys.argv[i] == "-subset":
+            i = i + 1
+            if i >= len(sys.argv):
+                usage()
+
+            subset = sys.argv[i]
+
+        elif sys.argv[i] == "-limit":
+            i = i + 1
+            if i >= len(sys.argv):
+                usage()
+
+            limit = int(sys.argv[i])
+            if limit <= 0:
+                usage()
+
+        elif sys.argv[i] == "-dry_run":
+            dry_run = True
+
+        elif sys.argv[i] == "-rescan":
+            full_rescan = True
+
+        elif sys.argv[i] == "-resume":
+            resume = True
+
+        elif sys.argv[i] == "-coordinator":
+            coordinator = True
+
+        elif sys.argv[i] == "-worker":
+            worker = True
+
+        elif sys.argv[i] == "-near":
+            i = i + 1
+            if i >= len(sys.argv):
+                usage()
+
+            near = sys.argv[i]
+
+        elif sys.argv[i] == "convert":
+            if mode is not None:
+                usage()
+            mode = DsfList.M_CONVERT
+
+        elif sys.argv[i] == "redo":
+            if mode is not None:
+                usage()
+            mode = DsfList.M_REDO
+
+        elif sys.argv[i] == "undo":
+            if mode is not None:
+                usage()
+            mode = DsfList.M_UNDO
+
+        elif sys.argv[i] == "update":
+            if mode is not None:
+                usage()
+            mode = DsfList.M_UPDATE
+
+        elif sys.argv[i] == "cleanup":
+            if mode is not None:
+                usage()
+            mode = DsfList.M_CLEANUP
+
+        else:
             usage()
 
-        xp12_root = sys.argv[i]
-        CFG["DEFAULTS"][
-            "xp12_root"
-        ] = xp12_root  # other values may be interpolated on xp12_root
-
-    elif sys.argv[i] == "-rect":
         i = i + 1
-        if i >= len(sys.argv):
-            usage()
 
-        m = re.match(r"([+-]\d\d)([+-]\d\d\d),([+-]\d\d)([+-]\d\d\d)", sys.argv[i])
-        if m is None:
-            usage()
+    if mode is None or (coordinator and worker) or (resume and (coordinator or worker)):
+        usage()
 
-        lat1 = int(m.group(1))
-        lon1 = int(m.group(2))
-        lat2 = int(m.group(3))
-        lon2 = int(m.group(4))
-        log.info(f"restricting to rect ({lat1},{lon1}) -> ({lat2},{lon2})")
-        rect = (lat1, lon1, lat2, lon2)
+    # added in 1.2
+    dir_re = CFG["DEFAULTS"].get(
+        "dir_re",
+        "zOrtho4XP_.*|z_autoortho.scenery.z_ao_[a-z]+|Orbx_.*_TE_Orthos|zVStates_.*",
+    )
 
-    elif sys.argv[i] == "-subset":
-        i = i + 1
-        if i >= len(sys.argv):
-            usage()
+    xp12_root = CFG["DEFAULTS"]["xp12_root"]
+    work_dir = CFG["DEFAULTS"]["work_dir"]
+    ortho_dir = CFG["DEFAULTS"]["ortho_dir"]
+    num_workers = int(CFG["DEFAULTS"]["num_workers"])
+    # added in 1.3, concurrency of the conversion stages, by default num_workers is split
+    # 3:3:4 across decode, encode and compress, start_pipeline() caps the tiles in flight at num_workers
+    n_decode = max(1, num_workers * 3 // 10)
+    n_encode = max(1, num_workers * 3 // 10)
+    n_compress = max(1, num_workers - n_decode - n_encode)
+    stage_workers = [
+        int(CFG["DEFAULTS"].get(k, str(n)))
+        for k, n in [("num_decoders", n_decode), ("num_encoders", n_encode), ("num_compressors", n_compress)]
+    ]
+    # get pyinstaller fs path, when running as script look next to it
+    if hasattr(sys, "_MEIPASS"):
+        MEIPASS_PATH = sys._MEIPASS
+    else:
+        MEIPASS_PATH = os.path.dirname(os.path.abspath(__file__))
+    # get dsf_tool or default to dsf_tool in pyinstaller bundle
+    dsf_tool = CFG["TOOLS"].get("dsf_tool", os.path.join(MEIPASS_PATH, "dsf_tool"))
+    # added in 1.3, "dsf_tool": round trip through dsf_tool's text format
+    #               "native": splice raster atoms into the binary DSF
+    engine = CFG["TOOLS"].get("engine", "dsf_tool")
+    if engine not in ["dsf_tool", "native"]:
+        log.error(f"engine: '{engine}' must be dsf_tool or native")
+        sys.exit(2)
+    # added in 1.3, compress with 7zip only if requested, default is the built in compressor
+    cmd_7zip = None
+    if CFG["TOOLS"].get("compressor", "builtin") == "7zip":
+        cmd_7zip = CFG["TOOLS"].get("7zip", os.path.join(MEIPASS_PATH, "7z"))
+
+    # added in 1.3, timeouts in seconds of a tool run per stage, 0 = none
+    # a tool that times out is killed and run again up to 'retries' times
+    for stage in DsfList.STAGES:
+        timeout = float(CFG["TOOLS"].get(f"timeout_{stage}", "0"))
+        if timeout > 0:
+            tool_timeouts[stage] = timeout
+    tool_retries = int(CFG["TOOLS"].get("retries", "1"))
+
+    sanity_checks = True
+    if not os.path.isdir(xp12_root):
+        sanity_checks = False
+        log.error(f"xp12_root: '{xp12_root}' is not a valid directory")
 
-        subset = sys.argv[i]
+    if not os.path.isdir(ortho_dir):
+        sanity_checks = False
+        log.error(f"ortho_dir: '{ortho_dir}' is not a valid directory")
 
-    elif sys.argv[i] == "-limit":
-        i = i + 1
-        if i >= len(sys.argv):
-            usage()
+    if engine == "dsf_tool" and not os.path.isfile(dsf_tool):
+        sanity_checks = False
+        log.error(f"dsf_tool: '{dsf_tool}' is not pointing to a file")
+
+    if cmd_7zip is not None and platform.system() == "Windows":
+        if not os.path.isfile(cmd_7zip):
+            sanity_checks = False
+            log.error(f"cmd_7zip: '{cmd_7zip}' is not pointing to a file")
+
+    if not sanity_checks:
+        sys.exit(2)
+
+    log.info(f"dir_re:    {dir_re}")
+    log.info(f"xp12_root: {xp12_root}")
+    log.info(f"ortho_dir: {ortho_dir}")
+    log.info(f"work_dir:  {work_dir}")
+    log.info(f"dsf_tool:  {dsf_tool}")
+    log.info(f"engine:    {engine}")
+    log.info(f"cmd_7zip:  {cmd_7zip}")
+    log.info(f"timeouts:  {tool_timeouts}, retries: {tool_retries}")
+    log.info(f"decoders/encoders/compressors: {stage_workers}")
+
+    dsf_list = DsfList(dir_re, xp12_root, ortho_dir)
+    # added in 1.3, check tiles while scanning so only convertible ones are queued
+    dsf_list.preflight = CFG["DEFAULTS"].getboolean("preflight", True)
+
+    # added in 1.3, order of conversion
+    #   fifo:      as found
+    #   largest:   largest DSFs first, keeps all workers busy until the end
+    #   proximity: closest to 'near' first
+    schedule = CFG["DEFAULTS"].get("schedule", "fifo")
+    if near is None:
+        near = CFG["DEFAULTS"].get("near", "")
+        if near == "":
+            near = None
+        elif schedule == "fifo":
+            schedule = "proximity"
+    else:
+        schedule = "proximity"  # -near on the command line
 
-        limit = int(sys.argv[i])
-        if limit <= 0:
-            usage()
+    if schedule not in DsfList.SCHEDULES:
+        log.error(f"schedule: '{schedule}' must be one of {DsfList.SCHEDULES}")
+        sys.exit(2)
 
-    elif sys.argv[i] == "-dry_run":
-        dry_run = True
+    if schedule == "proximity":
+        if near is None:
+            log.error("schedule: 'proximity' needs 'near'")
+            sys.exit(2)
 
-    elif sys.argv[i] == "convert":
-        if mode is not None:
-            usage()
-        mode = DsfList.M_CONVERT
+        m = re.match(r"\s*([+-]?[\d.]+)\s*,\s*([+-]?[\d.]+)\s*$", near)
+        if m is not None:
+            dsf_list.near = (float(m.group(1)), float(m.group(2)))
+        else:
+            try:
+                dsf_list.near = airport_lat_lon(xp12_root, near.upper())
+            except OSError as err:
+                log.error(f"near: can't read apt.dat: {err}")
+                sys.exit(2)
 
-    elif sys.argv[i] == "redo":
-        if mode is not None:
-            usage()
-        mode = DsfList.M_REDO
+            if dsf_list.near is None:
+                log.error(f"near: airport '{near}' not found")
+                sys.exit(2)
 
-    elif sys.argv[i] == "undo":
-        if mode is not None:
-            usage()
-        mode = DsfList.M_UNDO
+        log.info(f"schedule:  proximity to {near} {dsf_list.near}")
+    else:
+        log.info(f"schedule:  {schedule}")
 
-    elif sys.argv[i] == "cleanup":
-        if mode is not None:
-            usage()
-        mode = DsfList.M_CLEANUP
+    dsf_list.schedule = schedule
 
-    else:
-        usage()
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
 
-    i = i + 1
-
-if mode is None:
-    usage()
-
-# added in 1.2
-dir_re = CFG["DEFAULTS"].get(
-    "dir_re",
-    "zOrtho4XP_.*|z_autoortho.scenery.z_ao_[a-z]+|Orbx_.*_TE_Orthos|zVStates_.*",
-)
-
-xp12_root = CFG["DEFAULTS"]["xp12_root"]
-work_dir = CFG["DEFAULTS"]["work_dir"]
-ortho_dir = CFG["DEFAULTS"]["ortho_dir"]
-num_workers = int(CFG["DEFAULTS"]["num_workers"])
-# get pyinstaller fs path
-if hasattr(sys, "_MEIPASS"):
-    MEIPASS_PATH = sys._MEIPASS
-# get dsf_tool or default to dsf_tool in pyinstaller bundle
-dsf_tool = CFG["TOOLS"].get("dsf_tool", os.path.join(MEIPASS_PATH, "dsf_tool"))
-cmd_7zip = CFG["TOOLS"].get("7zip", os.path.join(MEIPASS_PATH, "7z"))
-
-sanity_checks = True
-if not os.path.isdir(xp12_root):
-    sanity_checks = False
-    log.error(f"xp12_root: '{xp12_root}' is not a valid directory")
-
-if not os.path.isdir(ortho_dir):
-    sanity_checks = False
-    log.error(f"ortho_dir: '{ortho_dir}' is not a valid directory")
-
-if not os.path.isfile(dsf_tool):
-    sanity_checks = False
-    log.error(f"dsf_tool: '{dsf_tool}' is not pointing to a file")
-
-if platform.system() == "Windows":
-    if not os.path.isfile(cmd_7zip):
-        sanity_checks = False
-        log.error(f"cmd_7zip: '{cmd_7zip}' is not pointing to a file")
+    if not os.access(work_dir, os.W_OK):
+        log.error(f"work_dir: '{work_dir}' is not writeable")
+        sys.exit(2)
 
-if not sanity_checks:
-    sys.exit(2)
+    # added in 1.3, tile id -> XP12 DSF, reused while XP12's directories are unchanged
+    xp12_map = Xp12Map(xp12_root)
+    xp12_map.setup(os.path.join(work_dir, "xp12_map.json"))
 
-log.info(f"dir_re:    {dir_re}")
-log.info(f"xp12_root: {xp12_root}")
-log.info(f"ortho_dir: {ortho_dir}")
-log.info(f"work_dir:  {work_dir}")
-log.info(f"dsf_tool:  {dsf_tool}")
-log.info(f"cmd_7zip:  {cmd_7zip}")
+    # added in 1.3, per tile and stage measurements, only runs that convert replace the last report
+    if not dry_run and not coordinator and DsfList.is_convert(mode):
+        run_report = RunReport(CFG["DEFAULTS"].get("report", "o4xp_2_xp12_report.jsonl"))
 
-dsf_list = DsfList(dir_re, xp12_root, ortho_dir)
+    # added in 1.3
+    if CFG["DEFAULTS"].getboolean("tile_index", True):
+        dsf_list.tile_index = TileIndex(os.path.join(work_dir, "tile_index.sqlite"))
+        dsf_list.full_rescan = full_rescan
 
-if not os.path.isdir(work_dir):
-    os.makedirs(work_dir)
+    # added in 1.3, budgets in MB, 0 = unlimited
+    max_ram = int(CFG["DEFAULTS"].get("max_ram", "0"))
+    max_tmp_disk = int(CFG["DEFAULTS"].get("max_tmp_disk", "0"))
+    if max_ram > 0 or max_tmp_disk > 0:
+        dsf_list.admission = Admission(
+            max_ram * 1024 * 1024, max_tmp_disk * 1024 * 1024, work_dir
+        )
+        log.info(f"max_ram: {max_ram} MB, max_tmp_disk: {max_tmp_disk} MB")
 
-if not os.access(work_dir, os.W_OK):
-    log.error(f"work_dir: '{work_dir}' is not writeable")
-    sys.exit(2)
+    # added in 1.3, size in MB, 0 disables the cache
+    raster_cache_size = int(CFG["DEFAULTS"].get("raster_cache_size", "2048"))
+    if raster_cache_size > 0:
+        raster_cache = RasterCache(
+            os.path.join(work_dir, "xp12_raster_cache"), raster_cache_size * 1024 * 1024
+        )
 
-dsf_list.scan(mode, limit, subset, rect)
+    # added in 1.3, layers of XP12 rasters to transfer, comma separated shell style patterns
+    if not CFG.has_section("RASTERS"):
+        CFG["RASTERS"] = {}
+    raster_include = CFG["RASTERS"].get("include", RASTER_INCLUDE)
+    raster_re = compile_include(raster_include)
+    log.info(f"rasters:   {raster_include}")
+
+    # added in 1.3, tiles without XP12 DSF get rasters resampled from the neighbouring tiles
+    #   no, nearest or bilinear, needs numpy
+    synthesize = CFG["RASTERS"].get("synthesize", "no")
+    if synthesize not in ["no", "nearest", "bilinear"]:
+        log.error(f"synthesize: '{synthesize}' must be no, nearest or bilinear")
+        sys.exit(2)
+    if synthesize != "no":
+        raster_synthesize = synthesize
+        log.info(f"synthesize: {synthesize} resampling of neighbours")
+
+    # added in 1.3, intermediate files of small tiles go to a RAM disk, size in MB, 0 = off
+    ram_dir_size = int(CFG["DEFAULTS"].get("ram_dir_size", "0"))
+    if ram_dir_size > 0:
+        ram_dir = CFG["DEFAULTS"].get("ram_dir", "/dev/shm/o4xp_2_xp12")
+        os.makedirs(ram_dir, exist_ok=True)
+        if not os.access(ram_dir, os.W_OK):
+            log.error(f"ram_dir: '{ram_dir}' is not writeable")
+            sys.exit(2)
+
+        scratch = ScratchTiers(ram_dir, ram_dir_size * 1024 * 1024, work_dir)
+        log.info(f"ram_dir:   {ram_dir}, {ram_dir_size} MB")
+
+    # added in 1.3, backups of the originals
+    #   method = link:  hardlink or reflink, copy only if the filesystem can't
+    #            copy:  always copy
+    #            store: content addressed store in store_dir, identical DSFs are kept once,
+    #                   should be on the filesystem of the ortho packs
+    if not CFG.has_section("BACKUP"):
+        CFG["BACKUP"] = {}
+    backup_method = CFG["BACKUP"].get("method", "link")
+    if backup_method not in ["link", "copy", "store"]:
+        log.error(f"backup method: '{backup_method}' must be link, copy or store")
+        sys.exit(2)
+
+    backup_link = backup_method != "copy"
+    if backup_method == "store":
+        store_dir = CFG["BACKUP"].get("store_dir", os.path.join(work_dir, "backup_store"))
+        backup_store = BackupStore(store_dir, CFG["BACKUP"].getboolean("compress", True))
+        log.info(f"backups:   store in {store_dir}, compress: {backup_store.compress}")
+    else:
+        log.info(f"backups:   {backup_method}")
+
+    # added in 1.3, distributed conversion through a queue in a shared directory
+    shared_queue = None
+    if coordinator or worker:
+        if not CFG.has_section("DISTRIBUTED") or CFG["DISTRIBUTED"].get("queue_dir", "") == "":
+            log.error("-coordinator and -worker need queue_dir in section [DISTRIBUTED]")
+            sys.exit(2)
+
+        shared_queue = SharedQueue(CFG["DISTRIBUTED"]["queue_dir"], dsf_list.ortho_dir, mode)
+        shared_queue.requeue_stale()
+        log.info(f"queue_dir: {shared_queue.queue_dir}")
 
-# dsf_list.queue.put(Dsf("E:/X-Plane-12/Custom Scenery/z_autoortho/scenery/z_ao_eur/Earth nav data/+50+000/+51+009.dsf"))
-if not dry_run:
-    dsf_list.execute(num_workers, mode)
+    # added in 1.3, journal of conversions for crash recovery and -resume
+    if not dry_run and not coordinator and DsfList.is_convert(mode):
+        try:
+            journal = JobJournal(os.path.join(work_dir, "journal.jsonl"))
+        except RuntimeError as err:
+            log.error(f"{err}, each process needs its own work_dir")
+            sys.exit(2)
+        journal.recover()
+
+    if resume:
+        if journal is None:
+            usage()
+        dsf_list.scan_journal(mode, limit)
+    elif worker:
+        dsf_list.queue = dsf_list.shared_queue = shared_queue
+        log.info(f"Shared queue: {shared_queue.status()}")
+    else:
+        dsf_list.scan(mode, limit, subset, rect)
+
+    if coordinator:
+        if not dry_run:
+            dsf_list.shared_queue = shared_queue
+            dsf_list.publish()
+        log.info(f"Shared queue: {shared_queue.status()}")
+        sys.exit(0)
+
+    # dsf_list.queue.put(Dsf("E:/X-Plane-12/Custom Scenery/z_autoortho/scenery/z_ao_eur/Earth nav data/+50+000/+51+009.dsf"))
+    if not dry_run:
+        if mode in [DsfList.M_UNDO, DsfList.M_CLEANUP] and not worker:
+            dsf_list.bulk(num_workers, mode)
+        else:
+            dsf_list.execute(num_workers, mode, stage_workers)
+        if backup_store is not None and mode in [DsfList.M_UNDO, DsfList.M_CLEANUP]:
+            backup_store.gc()
+        if worker:
+            log.info(f"Shared queue: {shared_queue.status()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
-import sys, struct, os
-from PIL import Image
+import sys, os, re
+import numpy as np
 import configparser
 
 class Raster():
@@ -9,16 +9,36 @@ class Raster():
     offset = 0
     flags = 5
     bpp = 2
+    version = 1
 
-    def __init__(self, fname):
+    def __init__(self, fname, width=None, height=None, bpp=None, flags=None, scale=None, offset=None):
         self.fname = fname
-        self.raw_data = open(fname, 'rb').read()
-        assert self.width * self.height * self.bpp == len(self.raw_data)
+        if width is not None:
+            self.width = width
+        if height is not None:
+            self.height = height
+        if bpp is not None:
+            self.bpp = bpp
+        if flags is not None:
+            self.flags = flags
+        if scale is not None:
+            self.scale = scale
+        if offset is not None:
+            self.offset = offset
+
+        assert self.width * self.height * self.bpp == os.path.getsize(fname)
+        # zero copy, pages are only read when accessed
+        self.data = np.memmap(fname, dtype=self.dtype(), mode='r',
+                              shape=(self.height, self.width))
         self.min = self.max = None
 
+    def dtype(self):
+        """numpy dtype by bpp and data type in flags bits 0-1: 0 float, 1 signed, 2 unsigned"""
+        kind = ['f', 'i', 'u'][self.flags & 3]
+        return np.dtype(f'<{kind}{self.bpp}')
+
     def get_val(self, x, y):
-        k = (y * self.width + x) * self.bpp
-        return struct.unpack('h', self.raw_data[k:k+self.bpp])[0]
+        return self.data[y, x].item()
 
     def get_val_ll_frac(self, lat_frac, lon_frac):
         """Get by lat/lan fraction [0..1)"""
@@ -27,98 +47,392 @@ class Raster():
 
         return self.get_val(int(lon_frac * self.width), int(lat_frac * self.height))
 
-    def get_min_max(self):
-        min_val = 100000
-        max_val = -100000
+    def post_centric(self):
+        """flags bit 2: values are at the posts, the first and last row/column on the tile's edges"""
+        return (self.flags & 4) != 0
 
-        for x in range(self.width):
-            for y in range(self.height):
-                val = self.get_val(x, y)
-                min_val = min(val, min_val)
-                max_val = max(val, max_val)
+    def pixel(self, frac, n):
+        """Fractional pixel coordinate of lat or lon fractions frac [0..1] for n pixels"""
+        if self.post_centric():
+            return frac * (n - 1)
+        return np.clip(frac * n - 0.5, 0, n - 1)
 
-        self.min = min_val
-        self.max = max_val
-        return (min_val, max_val)
+    def sample(self, lat_frac, lon_frac, bilinear=False):
+        """Values at arrays of lat/lon fractions [0..1], the arrays are broadcast against each other"""
+        y = self.pixel(np.asarray(lat_frac, dtype=np.float64), self.height)
+        x = self.pixel(np.asarray(lon_frac, dtype=np.float64), self.width)
+        if not bilinear or self.width < 2 or self.height < 2:
+            return self.data[np.rint(y).astype(np.intp), np.rint(x).astype(np.intp)].astype(np.float64)
+
+        y0 = np.clip(np.floor(y), 0, self.height - 2).astype(np.intp)
+        x0 = np.clip(np.floor(x), 0, self.width - 2).astype(np.intp)
+        fy = y - y0
+        fx = x - x0
+        d = self.data
+        return ((1 - fy) * ((1 - fx) * d[y0, x0] + fx * d[y0, x0 + 1])
+                + fy * ((1 - fx) * d[y0 + 1, x0] + fx * d[y0 + 1, x0 + 1]))
+
+    def get_min_max(self):
+        self.min = self.data.min().item()
+        self.max = self.data.max().item()
+        return (self.min, self.max)
 
     def make_png(self):
         if self.min is None:
             self.get_min_max()
 
-        img = Image.new('RGB', (self.width, self.height))# the image size
-        for x in range(self.width):
-            for y in range(self.height):
-                val = self.get_val(x, y)
-                red = 0
-                blue = 0
-                if val < 0:
-                    blue = int(255.0 * val / self.min)
-                if val > 0:
-                    red = int(255.0 * val / self.max)
+        val = np.asarray(self.data, dtype=np.float64)
+        rgb = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        if self.max > 0:
+            rgb[..., 0] = np.where(val > 0, 255.0 * val / self.max, 0)
+        if self.min < 0:
+            rgb[..., 2] = np.where(val < 0, 255.0 * val / self.min, 0)
 
-                img.putpixel((x, self.height - 1 - y), (red, 0, blue))
+        from PIL import Image   # only needed for PNGs, slow to import
 
+        img = Image.fromarray(rgb[::-1], 'RGB')   # north up
         png_name = os.path.basename(self.fname) + ".png"
         img.save(png_name)
         print(f"created {png_name}")
 
+LAYERS = ["spr1", "sum1", "fal1", "win1", "spr2", "sum2", "fal2", "win2",
+          "soundscape", "sea_level", "elevation"]
+
+# classes rather than quantities, never interpolated
+CATEGORICAL = ["soundscape"]
+
+def tile_name(lat, lon):
+    return f"{lat:+03d}{lon:+04d}"
+
+def find_rasters(dir, tile, layers):
+    """Return {layer: Raster} of the XP12 rasters of tile in dir.
+
+    Dimensions and data types are taken from the RASTER_DATA lines of the
+    dsf2text dump {tile}.txt-xp12 if it exists, otherwise the defaults of
+    Raster are assumed for {tile}.txt-xp12.{layer}.raw.
+    """
+    txt = os.path.join(dir, f"{tile}.txt-xp12")
+    rasters = {}
+    if os.path.isfile(txt):
+        with open(txt, "r") as f:
+            lines = [l for l in f if l.startswith("RASTER_")]
+        return {n: r for n, r in rasters_of_lines(lines, check=False).items() if n in layers}
+
+    for n in layers:
+        fn = f"{txt}.{n}.raw"
+        if os.path.isfile(fn):
+            rasters[n] = Raster(fn)
+    return rasters
+
+def rasters_of_lines(lines, check=True):
+    """Return {layer: Raster} of RASTER_DEF/RASTER_DATA lines of a dsf2text dump.
+
+    Without check rasters whose .raw file does not exist are left out.
+    """
+    names = []
+    rasters = {}
+    for l in lines:
+        if l.startswith("RASTER_DEF"):
+            names.append(l.split()[2])
+        elif l.startswith("RASTER_DATA"):
+            # RASTER_DATA version= bpp= flags= width= height= scale= offset= filename
+            words = l.rstrip("\r\n").split(" ", 8)
+            v = dict(w.split("=") for w in words[1:8])
+            name = names[len(rasters)] if len(rasters) < len(names) else None
+            rasters[name] = (words[8], v)
+
+    out = {}
+    for n, (fn, v) in rasters.items():
+        if not check and not os.path.isfile(fn):
+            continue
+        r = Raster(fn, int(v["width"]), int(v["height"]), int(v["bpp"]), int(v["flags"]),
+                   float(v["scale"]), float(v["offset"]))
+        r.version = int(v["version"])
+        out[n] = r
+    return out
+
+def resample(sources, ref, lat, bilinear):
+    """Values of a missing tile sampled from neighbours = [((dlat, dlon), Raster)].
+
+    The grid is that of Raster ref. Every pixel gets the value of the closest
+    point of each neighbour. With bilinear these are interpolated and blended
+    by inverse squared distance, otherwise the closest neighbour wins.
+    Returns physical values, raw * scale + offset of each neighbour.
+    """
+    n_y, n_x = ref.height, ref.width
+    if ref.post_centric():
+        y = np.linspace(0.0, 1.0, n_y)
+        x = np.linspace(0.0, 1.0, n_x)
+    else:
+        y = (np.arange(n_y) + 0.5) / n_y
+        x = (np.arange(n_x) + 0.5) / n_x
+    y = y[:, None]
+    x = x[None, :]
+    cos_lat = np.cos(np.radians(lat + 0.5))  # degrees of longitude are shorter
+
+    acc = np.zeros((n_y, n_x))
+    w_sum = np.zeros((n_y, n_x))
+    best_d = np.full((n_y, n_x), np.inf)
+    for (dlat, dlon), r in sources:
+        # closest point of the neighbour in its lat/lon fractions
+        cy = np.clip(y - dlat, 0.0, 1.0)
+        cx = np.clip(x - dlon, 0.0, 1.0)
+        d = np.hypot(y - dlat - cy, (x - dlon - cx) * cos_lat)
+        val = np.broadcast_to(r.sample(cy, cx, bilinear) * r.scale + r.offset, (n_y, n_x))
+        if bilinear:
+            w = 1.0 / np.maximum(d, 1e-6) ** 2
+            acc += w * val
+            w_sum += w
+        else:
+            closer = d < best_d
+            acc = np.where(closer, val, acc)
+            best_d = np.where(closer, d, best_d)
+
+    return acc / w_sum if bilinear else acc
+
+def synthesize(lat, neighbours, bilinear, prefix):
+    """Write the layers of a tile without XP12 DSF to {prefix}.{layer}.raw.
+
+    neighbours is {(dlat, dlon): {layer: Raster}} of the neighbouring XP12 tiles,
+    each layer takes the geometry and data type of an edge neighbour if possible.
+    Returns RASTER_DEF and RASTER_DATA lines as dsf2text writes them.
+    """
+    names = []
+    for rasters in neighbours.values():
+        names.extend(n for n in rasters if n not in names)
+    names.sort(key=lambda n: LAYERS.index(n) if n in LAYERS else len(LAYERS))
+
+    defs = []
+    data = []
+    for name in names:
+        sources = [(dll, rasters[name]) for dll, rasters in neighbours.items() if name in rasters]
+        ref = sources[0][1]
+        sources = [(dll, r) for dll, r in sources
+                   if (r.width, r.height, r.bpp, r.flags) == (ref.width, ref.height, ref.bpp, ref.flags)]
+
+        val = resample(sources, ref, lat, bilinear and name not in CATEGORICAL)
+        val = (val - ref.offset) / (ref.scale if ref.scale != 0 else 1.0)  # raw values of ref
+        dtype = ref.dtype()
+        if dtype.kind in "iu":
+            info = np.iinfo(dtype)
+            val = np.clip(np.rint(val), info.min, info.max)
+        raw = f"{prefix}.{name}.raw"
+        val.astype(dtype).tofile(raw)
+
+        defs.append(f"RASTER_DEF {len(defs)} {name}\n")
+        data.append(f"RASTER_DATA version={ref.version} bpp={ref.bpp} flags={ref.flags} width={ref.width}"
+                    f" height={ref.height} scale={ref.scale:.9g} offset={ref.offset:.9g} {raw}\n")
+
+    return defs + data
+
+def analyze_tile(args):
+    """Statistics, point samples and mosaic thumbnails of one tile, runs in a worker process"""
+    dir, lat, lon, layers, samples, mosaic_step = args
+    tile = tile_name(lat, lon)
+    stats = []
+    points = []
+    thumbs = {}
+    for layer, r in find_rasters(dir, tile, layers).items():
+        data = r.data
+        stats.append([tile, layer, r.width, r.height, r.bpp, r.flags,
+                      data.min().item(), data.max().item(),
+                      float(data.mean(dtype=np.float64)), float(data.std(dtype=np.float64))])
+        for k in range(samples):
+            for j in range(samples):
+                lat_frac = (k + 0.5) / samples
+                lon_frac = (j + 0.5) / samples
+                points.append([tile, layer, f"{lat + lat_frac:.6f}", f"{lon + lon_frac:.6f}",
+                               r.get_val_ll_frac(lat_frac, lon_frac)])
+        if mosaic_step > 0:
+            thumbs[layer] = np.array(data[::mosaic_step, ::mosaic_step], dtype=np.float64)
+
+    return (tile, stats, points, thumbs)
+
+def write_mosaic(layer, thumbs, tiles):
+    """Combine thumbnails {(lat, lon): array} to one PNG, colored as Raster.make_png"""
+    th = max(a.shape[0] for a in thumbs.values())
+    tw = max(a.shape[1] for a in thumbs.values())
+    lat_min = min(lat for lat, _ in tiles)
+    lat_max = max(lat for lat, _ in tiles)
+    lon_min = min(lon for _, lon in tiles)
+    lon_max = max(lon for _, lon in tiles)
+    vmin = min(a.min() for a in thumbs.values())
+    vmax = max(a.max() for a in thumbs.values())
+
+    rgb = np.zeros(((lat_max - lat_min + 1) * th, (lon_max - lon_min + 1) * tw, 3), dtype=np.uint8)
+    for (lat, lon), val in thumbs.items():
+        tile = np.zeros(val.shape + (3,), dtype=np.uint8)
+        if vmax > 0:
+            tile[..., 0] = np.where(val > 0, 255.0 * val / vmax, 0)
+        if vmin < 0:
+            tile[..., 2] = np.where(val < 0, 255.0 * val / vmin, 0)
+        y = (lat_max - lat) * th
+        x = (lon - lon_min) * tw
+        rgb[y:y + val.shape[0], x:x + val.shape[1]] = tile[::-1]   # north up
+
+    from PIL import Image
+
+    png_name = f"mosaic_{layer}.png"
+    Image.fromarray(rgb, 'RGB').save(png_name)
+    print(f"created {png_name}")
+
+def batch(dir, tiles, layers, out, samples, mosaic_step, workers):
+    """Analyze all layers of tiles with a process pool, write a CSV summary"""
+    import csv
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = [(dir, lat, lon, layers, samples, mosaic_step) for lat, lon in tiles]
+    mosaics = {}
+    n_found = 0
+    with open(out, "w", newline="") as f_out, ProcessPoolExecutor(max_workers=workers) as ex:
+        stats_csv = csv.writer(f_out)
+        stats_csv.writerow(["tile", "layer", "width", "height", "bpp", "flags",
+                            "min", "max", "mean", "std"])
+        if samples > 0:
+            samples_name = os.path.splitext(out)[0] + "_samples.csv"
+            f_samples = open(samples_name, "w", newline="")
+            samples_csv = csv.writer(f_samples)
+            samples_csv.writerow(["tile", "layer", "lat", "lon", "value"])
+
+        for (lat, lon), (tile, stats, points, thumbs) in zip(tiles, ex.map(analyze_tile, jobs, chunksize=4)):
+            if len(stats) == 0:
+                continue
+            n_found += 1
+            stats_csv.writerows(stats)
+            if samples > 0:
+                samples_csv.writerows(points)
+            for layer, a in thumbs.items():
+                mosaics.setdefault(layer, {})[(lat, lon)] = a
+
+        if samples > 0:
+            f_samples.close()
+            print(f"created {samples_name}")
+
+    print(f"created {out}, {n_found} of {len(tiles)} tiles have rasters")
+    for layer, thumbs in mosaics.items():
+        write_mosaic(layer, thumbs, list(thumbs.keys()))
+
 def usage():
     print( \
-    """raster_tool [-make_png] lat lon""")
+    """raster_tool [-make_png] lat lon
+raster_tool -batch [-rect lower_left,upper_right] [-tiles tile,tile,...] [-layers layer,layer,...]
+            [-dir dir] [-out summary.csv] [-samples n] [-mosaic step] [-workers n]
+    -batch      analyze all layers of many tiles
+    -rect       tiles in the rectangle, corners format is lat,lon, e.g. +50+009
+    -tiles      list of tiles, e.g. +50+009,+51+010
+    -layers     layers to analyze, default is all
+    -dir        directory of the {tile}.txt-xp12 dumps, default is work_dir
+    -out        CSV file of per tile and layer statistics
+    -samples n  also write a n x n grid of point samples per tile to <out>_samples.csv
+    -mosaic s   write a PNG mosaic per layer using every s-th pixel
+    -workers n  number of worker processes""")
     exit(1)
 
-###########
-## main
-###########
-CFG = configparser.ConfigParser()
-CFG.read('o4xp_2_xp12.ini')
+def main():
+    CFG = configparser.ConfigParser()
+    CFG.read('o4xp_2_xp12.ini')
 
-work_dir = CFG['DEFAULTS']['work_dir']
+    work_dir = CFG['DEFAULTS']['work_dir']
 
-make_png = False
+    make_png = False
+    batch_mode = False
+    tiles = []
+    layers = LAYERS
+    dir = work_dir
+    out = "raster_summary.csv"
+    samples = 0
+    mosaic_step = 0
+    workers = None
+    lat = lon = None
 
-if len(sys.argv) < 3:
-    usage()
+    if len(sys.argv) < 2:
+        usage()
 
-i = 1
-while i < len(sys.argv):
-    if sys.argv[i] == "-make_png":
-        make_png = True
-    elif len(sys.argv) - i == 2:
-        lat = sys.argv[i]
+    i = 1
+    while i < len(sys.argv):
+        arg = sys.argv[i]
+        if arg == "-make_png":
+            make_png = True
+        elif arg == "-batch":
+            batch_mode = True
+        elif arg in ["-rect", "-tiles", "-layers", "-dir", "-out", "-samples", "-mosaic", "-workers"]:
+            i = i + 1
+            if i >= len(sys.argv):
+                usage()
+            val = sys.argv[i]
+            if arg == "-rect":
+                m = re.match(r"([+-]\d\d)([+-]\d\d\d),([+-]\d\d)([+-]\d\d\d)", val)
+                if m is None:
+                    usage()
+                lat1, lon1, lat2, lon2 = [int(g) for g in m.groups()]
+                tiles.extend((lat, lon) for lat in range(lat1, lat2 + 1) for lon in range(lon1, lon2 + 1))
+            elif arg == "-tiles":
+                for t in val.split(","):
+                    m = re.match(r"([+-]\d\d)([+-]\d\d\d)$", t)
+                    if m is None:
+                        usage()
+                    tiles.append((int(m.group(1)), int(m.group(2))))
+            elif arg == "-layers":
+                layers = val.split(",")
+            elif arg == "-dir":
+                dir = val
+            elif arg == "-out":
+                out = val
+            elif arg == "-samples":
+                samples = int(val)
+            elif arg == "-mosaic":
+                mosaic_step = int(val)
+            elif arg == "-workers":
+                workers = int(val)
+        elif not batch_mode and len(sys.argv) - i == 2:
+            lat = sys.argv[i]
+            i = i + 1
+            lon = sys.argv[i]
+        else:
+            usage()
         i = i + 1
-        lon = sys.argv[i]
-    else:
+
+    if batch_mode:
+        if len(tiles) == 0:
+            usage()
+        batch(dir, tiles, layers, out, samples, mosaic_step, workers)
+        return
+
+    if lat is None:
         usage()
-    i = i + 1
 
-lat = float(lat)
-lon = float(lon)
-#print(lat, lon)
+    lat = float(lat)
+    lon = float(lon)
+    #print(lat, lon)
 
-# corner
-lat_c = int(lat)
-lat_frac = lat - lat_c
-lon_c = int(lon)
-lon_frac = lon - lon_c
+    # corner
+    lat_c = int(lat)
+    lat_frac = lat - lat_c
+    lon_c = int(lon)
+    lon_frac = lon - lon_c
 
-fname_sea = os.path.join(work_dir, f"{lat_c:+03d}{lon_c:+04d}.txt-xp12.sea_level.raw")
-fname_elevation = os.path.join(work_dir, f"{lat_c:+03d}{lon_c:+04d}.txt-xp12.elevation.raw")
-#print(fname_sea)
+    fname_sea = os.path.join(work_dir, f"{lat_c:+03d}{lon_c:+04d}.txt-xp12.sea_level.raw")
+    fname_elevation = os.path.join(work_dir, f"{lat_c:+03d}{lon_c:+04d}.txt-xp12.elevation.raw")
+    #print(fname_sea)
 
-sea = Raster(fname_sea)
-elevation = Raster(fname_elevation)
+    sea = Raster(fname_sea)
+    elevation = Raster(fname_elevation)
 
-#min_val, max_val = sea.get_min_max()
-#print(f"min: {min_val}, max: {max_val}")
+    #min_val, max_val = sea.get_min_max()
+    #print(f"min: {min_val}, max: {max_val}")
 
-if make_png:
-    sea.make_png()
-    elevation.make_png()
-    exit()
+    if make_png:
+        sea.make_png()
+        elevation.make_png()
+        exit()
 
-sv = sea.get_val_ll_frac(lat_frac, lon_frac)
-ev = elevation.get_val_ll_frac(lat_frac, lon_frac)
+    sv = sea.get_val_ll_frac(lat_frac, lon_frac)
+    ev = elevation.get_val_ll_frac(lat_frac, lon_frac)
 
-print(f"sea value: {sv}, elevation value: {ev}")
+    print(f"sea value: {sv}, elevation value: {ev}")
 
+###########
+## main
+###########
+if __name__ == "__main__":
+    main()